@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""future for asynchronous requests of channels
+"""
+
+import threading
+import time
+
+
+class FutureTimeoutError(Exception):
+    """future is not done in the given time
+    """
+    pass
+
+
+class Future(object):
+    """a lightweight future, no event is created until someone blocks on it
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._evt = None
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        """resolve future with a result
+
+        :returns: False if future is already done
+        """
+        return self._resolve(result, None)
+
+    def set_exception(self, exception):
+        """resolve future with an exception
+
+        :returns: False if future is already done
+        """
+        return self._resolve(None, exception)
+
+    def _resolve(self, result, exception):
+        with self._lock:
+            if self._done:
+                return False
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, None
+            evt = self._evt
+        if evt:
+            evt.set()
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def add_done_callback(self, callback):
+        """call callback with the future when it's done, callback is called at once if already done
+        """
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def remove_done_callback(self, callback):
+        with self._lock:
+            if not self._done and callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait(self, timeout=None):
+        """wait for future to be done
+
+        :returns: whether future is done
+        """
+        if self._done:
+            return True
+        with self._lock:
+            if not self._done and self._evt is None:
+                self._evt = threading.Event()
+            evt = self._evt
+        if evt:
+            evt.wait(timeout)
+        return self._done
+
+    def result(self, timeout=None):
+        """get result of future, exception resolved is raised
+        """
+        if not self.wait(timeout):
+            raise FutureTimeoutError("future is not done in %ss" % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """get exception of future, None if resolved with a result
+        """
+        if not self.wait(timeout):
+            raise FutureTimeoutError("future is not done in %ss" % timeout)
+        return self._exception
+
+
+def gather(futures, timeout=None):
+    """wait for all futures and get their results in order, the first exception met is raised
+
+    :param futures: futures to wait
+    :type  futures: list
+    :param timeout: timeout for all futures, None for no limit
+    :type  timeout: float
+    :returns: list of results
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+    results = []
+    for future in futures:
+        if timeout is not None:
+            timeout = max(deadline - time.time(), 0)
+        results.append(future.result(timeout))
+    return results
+
+
+def wait_any(futures, timeout=None):
+    """wait until any of the futures is done
+
+    :param futures: futures to wait
+    :type  futures: list
+    :param timeout: timeout, None for no limit
+    :type  timeout: float
+    :returns: the first done future, None if timeout
+    """
+    for future in futures:
+        if future.done():
+            return future
+    evt = threading.Event()
+    done_futures = []
+
+    def on_done(future):
+        done_futures.append(future)
+        evt.set()
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    evt.wait(timeout)
+    for future in futures:
+        future.remove_done_callback(on_done)
+    if done_futures:
+        return done_futures[0]
+    return None
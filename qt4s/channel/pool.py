@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""pooled socket channel keeping several connections to the same address
+"""
+
+import itertools
+import socket
+import threading
+import time
+
+from qt4s.channel.base import ChannelBase
+from qt4s.channel.sock import SocketConnectionClosedError, SocketConnectionTimeoutError
+
+
+class EnumChannelPoolPolicy(object):
+    """policy to choose a connection for a request
+    """
+    ROUND_ROBIN = "round_robin"
+    LEAST_OUTSTANDING = "least_outstanding"
+
+
+class PooledSocketChannel(ChannelBase):
+    """socket channel dispatching requests over several connections, broken connections are reconnected in background
+
+    allowed keyword-arguments are the same as channel_class, with the followings in addition:
+
+    :param pool_size: number of connections
+    :type  pool_size: int
+    :param pool_policy: dispatching policy, see EnumChannelPoolPolicy
+    :type  pool_policy: str
+
+    connections of the pool are given consecutive affinity keys, so they are spread over ioloops
+    with "hash" ioloop policy
+    """
+    channel_class = None  # subclass of SocketChannel for each connection
+    pool_size = 4
+    pool_policy = EnumChannelPoolPolicy.LEAST_OUTSTANDING
+    reconnect_interval = 1
+    _pool_counter = itertools.count()
+
+    def __init__(self, account_or_user=None, **kwargs):
+        if self.channel_class is None:
+            raise ValueError("channel_class of %s is not specified" % type(self).__name__)
+        self._pool_size = kwargs.pop("pool_size", self.pool_size)
+        self._policy = kwargs.pop("pool_policy", self.pool_policy)
+        if self._pool_size < 1:
+            raise ValueError("pool_size=%r must be positive" % self._pool_size)
+        if self._policy not in (EnumChannelPoolPolicy.ROUND_ROBIN, EnumChannelPoolPolicy.LEAST_OUTSTANDING):
+            raise ValueError("unknown pool_policy=%r" % self._policy)
+        self.request_class = self.channel_class.request_class
+        super(PooledSocketChannel, self).__init__(account_or_user=account_or_user, **kwargs)
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._closed = False
+        self._reconnecting = set()
+        affinity_key = self.kwargs.pop("affinity_key", None)
+        if affinity_key is None:
+            self._affinity_base = next(self._pool_counter) * self._pool_size
+        else:
+            self._affinity_base = hash(affinity_key)
+        self._channels = [self.create_channel(i) for i in range(self._pool_size)]
+
+    def get_connection(self):
+        return None  # connections are owned by member channels
+
+    def create_channel(self, index=0):
+        """create a member channel
+
+        :param index: index of member channel in pool
+        :type  index: int
+        """
+        return self.channel_class(self._user, affinity_key=self._affinity_base + index, **self.kwargs)
+
+    @property
+    def channels(self):
+        return list(self._channels)
+
+    def get_channel(self):
+        """choose a member channel by pool policy, broken channels are skipped
+        """
+        if self._closed:
+            raise SocketConnectionClosedError("channel pool is closed")
+        candidates = []
+        for index, chan in enumerate(self._channels):
+            if chan.broken:
+                self._reconnect(index)
+            else:
+                candidates.append(chan)
+        if not candidates:
+            raise SocketConnectionClosedError("no available connection in pool, reconnecting")
+        if self._policy == EnumChannelPoolPolicy.ROUND_ROBIN:
+            return candidates[next(self._counter) % len(candidates)]
+        return min(candidates, key=lambda chan: chan.pending_count)
+
+    def send(self, request):
+        return self._dispatch(lambda chan: chan.send(request))
+
+    def send_async(self, request):
+        return self._dispatch(lambda chan: chan.send_async(request))
+
+    def get_response(self, request):
+        return self._dispatch(lambda chan: chan.get_response(request))
+
+    def _dispatch(self, func):
+        chan = self.get_channel()
+        try:
+            return func(chan)
+        except (socket.error, SocketConnectionTimeoutError):
+            if chan in self._channels:
+                self._reconnect(self._channels.index(chan))
+            raise
+
+    def _reconnect(self, index):
+        with self._lock:
+            if self._closed or index in self._reconnecting:
+                return
+            self._reconnecting.add(index)
+        t = threading.Thread(target=self._reconnect_thread_func, args=(index,))
+        t.daemon = True
+        t.start()
+
+    def _reconnect_thread_func(self, index):
+        try:
+            while not self._closed:
+                chan = self.create_channel(index)
+                try:
+                    chan.connect()
+                except (socket.error, SocketConnectionTimeoutError):
+                    chan.close()
+                    time.sleep(self.reconnect_interval)
+                    continue
+                with self._lock:
+                    old_chan = self._channels[index]
+                    if self._closed:
+                        old_chan = chan
+                    else:
+                        self._channels[index] = chan
+                old_chan.close()
+                break
+        finally:
+            with self._lock:
+                self._reconnecting.discard(index)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        for chan in self._channels:
+            chan.close()
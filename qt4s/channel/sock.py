@@ -1,16 +1,17 @@
 """socket channel of qt4s
 """
+import struct
 import threading
 
 from qt4s.addressing.direct import DirectAddressing
 from qt4s.channel.base import ChannelBase, IRequest, IResponse
+from qt4s.channel.future import Future
 from qt4s.connections.sock import SocketCallback, SocketConn, EnumConnType
-from qt4s.message.definition import Message
+from qt4s.message.definition import Message, Dict, String
+from qt4s.message.serializers.binary import BinarySerializer, BinaryLayout, TYPE_FLAG_MAP
 from qt4s.message.utils import size_of, field_size_of, offset_of
 from qt4s.util import SequenceGenerator
 
-_no_packet = object()
-
 
 class SocketConnectionTimeoutError(Exception):
     pass
@@ -20,11 +21,199 @@ class SocketGetResponseTimeoutError(Exception):
     pass
 
 
+class SocketConnectionClosedError(Exception):
+    pass
+
+
+class FramePlan(object):
+    """precompiled plan to read the length field of a packet at a fixed offset
+    """
+
+    def __init__(self, offset, fmt, adjust=0):
+        self.offset = offset
+        self.struct = struct.Struct(fmt)
+        self.end = offset + self.struct.size
+        self.adjust = adjust
+
+    def read_length(self, buff):
+        """read packet length from buffer head, the packet may not be completely received
+
+        :returns: packet length, None if length field is not received
+        """
+        if len(buff) < self.end:
+            return None
+        return self.struct.unpack_from(buff, self.offset)[0] + self.adjust
+
+    def get_message_length(self, buff):
+        """get packet length from buffer head
+
+        :returns: packet length, None if buffer is not long enough
+        """
+        expected_len = self.read_length(buff)
+        if expected_len is None or len(buff) < expected_len:
+            return None
+        return expected_len
+
+
+class PacketDecoder(object):
+    """resumable decoder of packets from a receive buffer
+
+    Length of a pending packet is parsed only once. If the packet class defines _stream_field_,
+    the trailing Buffer field named so is streamed as chunks while they are received.
+    """
+    probe_size = 4096  # initial size of data passed to an overridden get_message_length
+
+    def __init__(self, packet_class, serializer=None):
+        self._packet_class = packet_class
+        self._serializer = serializer or packet_class._serializer_
+        self._plan = None
+        if getattr(packet_class, "_length_field_", None) is not None \
+            and packet_class.get_message_length.__func__ is PacketBase.get_message_length.__func__:
+            self._plan = packet_class.get_frame_plan(self._serializer)
+        self._stream_offset = self._get_stream_offset()
+        self._packet_len = None
+        self._streaming_packet = None
+        self._stream_remain = 0
+
+    def _get_stream_offset(self):
+        stream_field = getattr(self._packet_class, "_stream_field_", None)
+        if stream_field is None:
+            return None
+        if self._plan is None:
+            raise ValueError("packet with _stream_field_ must have a static _length_field_")
+        layout = BinaryLayout.get(self._packet_class.get_struct_class())
+        index = layout.index_of(stream_field)
+        if index != len(layout.fields) - 1 or layout.offsets[index] is None \
+            or not issubclass(layout.fields[index].type, String):
+            raise ValueError("_stream_field_ must be the last String field after fixed size fields")
+        return layout.offsets[index]
+
+    def _get_message_length(self, recv_buf):
+        """call get_message_length of packet class with bounded copies of buffered data, the copy
+        is doubled until it holds more than the packet found or all of the buffered data
+        """
+        packet = self._packet_class()
+        size = self.probe_size
+        while True:
+            buff = recv_buf.peek(size).tobytes()
+            packet_len = packet.get_message_length(buff, self._serializer)
+            if len(buff) == len(recv_buf) or (packet_len and packet_len < len(buff)):
+                return packet_len
+            size *= 2
+
+    def _load(self, data):
+        packet = self._packet_class()
+        remain_data = packet.loads(data, self._serializer)
+        if remain_data:
+            print("[WARNING]data=%s remained after response laoding" % remain_data)
+        return packet
+
+    def decode(self, recv_buf, on_packet, on_chunk=None):
+        """decode packets in buffer
+
+        :param recv_buf: receive buffer
+        :type  recv_buf: qt4s.connections.sock.ReceiveBuffer
+        :param on_packet: callback with a complete packet, stream field of the packet is empty if streamed
+        :param on_chunk: callback with packet and a chunk of its stream field
+        """
+        while recv_buf:
+            if self._streaming_packet is not None:
+                chunk = recv_buf.read(self._stream_remain)
+                self._stream_remain -= len(chunk)
+                on_chunk(self._streaming_packet, chunk)
+                if self._stream_remain:
+                    break
+                packet, self._streaming_packet = self._streaming_packet, None
+                on_packet(packet)
+                continue
+
+            if self._plan is None:
+                packet_len = self._get_message_length(recv_buf)
+                if not packet_len:
+                    break
+                on_packet(self._load(recv_buf.read(packet_len)))
+                continue
+
+            if self._packet_len is None:
+                self._packet_len = self._plan.read_length(recv_buf.peek(self._plan.end))
+                if self._packet_len is None:
+                    break
+            if self._stream_offset is not None and len(recv_buf) >= self._stream_offset:
+                packet = self._packet_class()
+                data, _ = self._serializer.loads(self._packet_class.get_struct_class(),
+                                                 recv_buf.read(self._stream_offset))
+                packet.get_struct().construct(data)
+                self._streaming_packet = packet
+                self._stream_remain = self._packet_len - self._stream_offset
+                self._packet_len = None
+                if not self._stream_remain:
+                    self._streaming_packet = None
+                    on_packet(packet)
+                continue
+            if len(recv_buf) < self._packet_len:
+                break
+            packet_len, self._packet_len = self._packet_len, None
+            on_packet(self._load(recv_buf.read(packet_len)))
+
+
+def compile_frame_plan(packet_class, serializer):
+    """compile the framing plan of packet class with a length field
+
+    :returns: frame plan, None if length field could not be located statically
+    """
+    if not isinstance(serializer, BinarySerializer):
+        return None
+    struct_class = packet_class.get_struct_class()
+    offset = 0
+    attr_parts = packet_class._length_field_.split(".")
+    for i, attr_part in enumerate(attr_parts):
+        if not issubclass(struct_class, Dict):
+            return None
+        layout = BinaryLayout.get(struct_class)
+        try:
+            index = layout.index_of(attr_part)
+        except ValueError:
+            raise RuntimeError('length field named "%s" not found' % packet_class._length_field_)
+        if layout.offsets[index] is None:
+            return None
+        offset += layout.offsets[index]
+        field_info = layout.fields[index]
+        struct_class = field_info.type
+    flag = TYPE_FLAG_MAP.get(field_info.type)
+    if not flag or "serializer" in field_info.params:
+        return None
+    return FramePlan(offset, serializer._endian + flag, packet_class._length_adjust_)
+
+
+class ResponseFuture(Future):
+    """future of a socket request, response is post processed when got from a channel
+    """
+
+    def __init__(self, request, chan=None):
+        super(ResponseFuture, self).__init__()
+        self.request = request
+        self.timer = None
+        self._chan = chan
+        self._processed = False
+
+    def result(self, timeout=None):
+        response = super(ResponseFuture, self).result(timeout)
+        if self._chan is not None and not self._processed:
+            with self._lock:
+                processed, self._processed = self._processed, True
+            if not processed:
+                response.set_request(self.request)
+                response.post_process(self._chan)
+        return response
+
+
 class PacketBase(Message):
     """base class of a packet
     """
     _struct_ = []
     _length_fields_ = None
+    _length_adjust_ = 0  # packet length = value of length field + _length_adjust_
+    _stream_field_ = None  # name of trailing Buffer field which is received as chunks, see PacketDecoder
 
     def __init__(self, *args, **kwargs):
         super(PacketBase, self).__init__(*args, **kwargs)
@@ -38,18 +227,36 @@ class PacketBase(Message):
         if getattr(self, "_length_field_", None) is None:
             return
 
-        packet_size = size_of(self, serializer)
+        packet_size = size_of(self, serializer) - self._length_adjust_
         attr_parts = self._length_field_.split(".")
         value = self
         for attr_part in attr_parts[:-1]:
             value = getattr(self, attr_part)
         setattr(value, attr_parts[-1], packet_size)
 
+    @classmethod
+    def get_frame_plan(cls, serializer):
+        """get compiled frame plan of the packet class, which is cached on the class per serializer type and endian
+        """
+        plans = cls.__dict__.get("_frame_plans_")
+        if plans is None:
+            plans = {}
+            setattr(cls, "_frame_plans_", plans)
+        key = (type(serializer), getattr(serializer, "_endian", None))
+        try:
+            return plans[key]
+        except KeyError:
+            plan = plans[key] = compile_frame_plan(cls, serializer)
+            return plan
+
     def get_message_length(self, buff, serializer):
         if getattr(self, "_length_field_", None) is None:
             return len(buff)
 
         serializer = serializer or self._serializer_
+        plan = self.get_frame_plan(serializer)
+        if plan:
+            return plan.get_message_length(buff)
         buf_len = len(buff)
         length_field = self._length_field_
         start_pos = offset_of(self, length_field, serializer)
@@ -68,7 +275,11 @@ class PacketBase(Message):
                 break
         else:
             raise RuntimeError('length field named "%s" not found' % length_field)
-        expected_len, _ = serializer.loads(field_type, buff[start_pos:end_pos])
+        length_buff = buff[start_pos:end_pos]
+        if isinstance(length_buff, memoryview):
+            length_buff = length_buff.tobytes()
+        expected_len, _ = serializer.loads(field_type, length_buff)
+        expected_len += self._length_adjust_
         if buf_len < expected_len:
             return None
         return expected_len
@@ -122,19 +333,24 @@ class SocketChannel(ChannelBase, SocketCallback):
         :type  conn_type: str
         :param connect_timeout: timeout for create connection
         :type  connect_timeout: float
+        :param affinity_key: connections with the same key share an ioloop with "hash" ioloop policy
+        :type  affinity_key: hashable object
         """
         super(SocketChannel, self).__init__(account_or_user=account_or_user, **kwargs)
 
         self._lock = threading.Lock()
         self._evt = threading.Event()
         self._seq_generator = None
-        self._pending_pairs = {}
+        self._pending_lock = threading.Lock()
+        self._pending_futures = {}
         self._connected = False
-        self._tcp_buf = ""
+        self._broken = False
+        self._decoder = None
         self._connect_timeout = self.kwargs.get("connect_timeout", 10)
 
     def get_connection(self):
         address = DirectAddressing(self.kwargs).get_address()
+        address["affinity_key"] = self.kwargs.get("affinity_key", None)
         return SocketConn(address, self)
 
     @property
@@ -143,6 +359,27 @@ class SocketChannel(ChannelBase, SocketCallback):
         """
         return self._connected
 
+    @property
+    def broken(self):
+        """is underlayer connection closed or failed
+        """
+        return self._broken
+
+    @property
+    def pending_count(self):
+        """number of requests waiting for response
+        """
+        return len(self._pending_futures)
+
+    def connect(self):
+        """connect to server if not connected
+        """
+        if not self._connected:  # avoid lock acquiring
+            with self._lock:
+                if not self._connected:
+                    self.wait_for_connected()
+                    self._connected = True
+
     def create_seq(self, min_val=0, max_val=0x7fffffff):
         """create an unique sequence number within channel scope
         
@@ -156,32 +393,58 @@ class SocketChannel(ChannelBase, SocketCallback):
         return self._seq_generator.create_seq()
 
     def get_response(self, request):
+        return self.get_response_async(request).result()
+
+    def send_async(self, request):
+        """send a request to server without waiting for response
+
+        :returns: future resolved with the post processed response,
+                  or SocketGetResponseTimeoutError if no response in request timeout
+        :rtype: ResponseFuture
+        """
+        if not isinstance(request, self.request_class):
+            raise TypeError("request=%r does not match %r" % (request, self.request_class))
+        request.pre_process(self)
+        return self.get_response_async(request, ResponseFuture(request, self))
+
+    def get_response_async(self, request, future=None):
+        """send a request and get a future of the raw response
+        """
         buff = request.dumps()
         sequence_id = request.get_sequence_id()
-        if request in self._pending_pairs:
-            raise ValueError("request with sequence_id=%s is already in pending pairs" % sequence_id)
         if self._conn.socket_type == EnumConnType.UDP:
             sequence_id = (sequence_id, (self._conn.host, self._conn.port))
-        evt = threading.Event()
-
-        if not self._connected:  # avoid lock acquiring
-            with self._lock:
-                if not self._connected:
-                    self.wait_for_connected()
-                    self._connected = True
-
-        self._pending_pairs[sequence_id] = (evt, _no_packet)
-        self._conn.send(buff)
-
-        evt = self._pending_pairs[sequence_id][0]
-        evt.wait(request.get_timeout())
-        rsp = self._pending_pairs[sequence_id][1]
-        with self._lock:
-            del self._pending_pairs[sequence_id]
-        if rsp == _no_packet:
-            raise SocketGetResponseTimeoutError("no response for sequence_id=%s in %ss" % (sequence_id,
-                                                                                           request.get_timeout()))
-        return rsp
+        if future is None:
+            future = ResponseFuture(request)
+        self.connect()
+        with self._pending_lock:
+            if sequence_id in self._pending_futures:
+                raise ValueError("request with sequence_id=%s is already in pending pairs" % sequence_id)
+            self._pending_futures[sequence_id] = future
+        timeout = request.get_timeout()
+        if timeout is not None:
+            future.timer = self._conn.ioloop.call_later(timeout, self._on_request_timeout, sequence_id, future)
+        try:
+            self._conn.send(buff)
+        except:
+            self._pop_pending(sequence_id, future)
+            raise
+        return future
+
+    def _pop_pending(self, key, future=None):
+        with self._pending_lock:
+            pending_future = self._pending_futures.get(key)
+            if pending_future is None or (future is not None and pending_future is not future):
+                return None
+            del self._pending_futures[key]
+        if pending_future.timer:
+            pending_future.timer.cancel()
+        return pending_future
+
+    def _on_request_timeout(self, key, future):
+        if self._pop_pending(key, future):
+            future.set_exception(SocketGetResponseTimeoutError("no response for sequence_id=%s in %ss" % (
+                key, future.request.get_timeout())))
 
     def wait_for_connected(self):
         self._conn.connect()
@@ -196,38 +459,54 @@ class SocketChannel(ChannelBase, SocketCallback):
     def on_connected(self):
         self._evt.set()
 
+    def on_closed(self):
+        self._broken = True
+        self._fail_pending(SocketConnectionClosedError("connection to %s:%s is closed" % (self._conn.host,
+                                                                                            self._conn.port)))
+
+    def on_error(self, e, stack):
+        self._broken = True
+        super(SocketChannel, self).on_error(e, stack)
+        self._fail_pending(e)
+
+    def _fail_pending(self, e):
+        with self._pending_lock:
+            futures, self._pending_futures = self._pending_futures, {}
+        for future in futures.values():
+            if future.timer:
+                future.timer.cancel()
+            future.set_exception(e)
+
     def on_recv(self):
         with self._lock:
             response_class = self.request_class.response_class
-            response = response_class()
             if self._conn.socket_type == EnumConnType.UDP:
+                response = response_class()
                 packet_buff, addr = self._conn.read()
                 response.loads(packet_buff)
                 sequence_id = response.get_sequence_id()
                 sequence_id = (sequence_id, addr)
                 self.notify(sequence_id, response)
             else:
-                self._tcp_buf += self._conn.read()
-                while True:
-                    packet_len = response.get_message_length(self._tcp_buf, None)
-                    if not packet_len:
-                        break
-                    else:
-                        packet_buff = self._tcp_buf[:packet_len]
-                        self._tcp_buf = self._tcp_buf[packet_len:]
-                        remain_data = response.loads(packet_buff)
-                        if remain_data:
-                            print("[WARNING]data=%s remained after response laoding" % remain_data)
-                        sequence_id = response.get_sequence_id()
-                        self.notify(sequence_id, response)
+                if self._decoder is None:
+                    self._decoder = PacketDecoder(response_class)
+                self._decoder.decode(self._conn.recv_buffer, self._on_response, self.on_response_chunk)
+
+    def _on_response(self, response):
+        self.notify(response.get_sequence_id(), response)
+
+    def on_response_chunk(self, response, chunk):
+        """handle a chunk of the stream field of response, which is only for response class with _stream_field_
+        """
+        raise NotImplementedError("%s must implement on_response_chunk to receive streamed %s" % (
+            type(self).__name__, type(response).__name__))
 
     def notify(self, key, resposne):
         """notify channel that a response is available
         """
-        if key in self._pending_pairs:
-            evt = self._pending_pairs[key][0]
-            self._pending_pairs[key] = (evt, resposne)
-            evt.set()
+        future = self._pop_pending(key)
+        if future:
+            future.set_result(resposne)
         else:
             self.on_push(resposne)
 
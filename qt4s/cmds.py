@@ -13,6 +13,7 @@ from testbase.management import Command
 from qt4s.message.parsers.jce import JceParser, JceCodeGenerator, JceLangExt
 from qt4s.message.parsers.taf import TAFJceCodeGenerator
 from qt4s.message.compiler import Compiler
+from qt4s.message.serializers.jce_codec import generate_codec_file
 
 
 class ProtoCompile(Command):
@@ -23,6 +24,7 @@ class ProtoCompile(Command):
     parser.add_argument('target', help="protocol file path")
     parser.add_argument('-t', '--type', dest='type', default='auto', help="designate protocol file type, could be \"pb\" \"jce\" default is \"auto\"")
     parser.add_argument('-I', '--include', default=[], nargs='*', dest='include_paths', help="include protocol file path")
+    parser.add_argument('--jce-codec', action='store_true', dest='jce_codec', help="generate specialized encoders and decoders for jce messages into *_jce_codec.py")
 
     def _compile_pb(self, protoc_path, target, include_paths):
         include_paths = include_paths[:]
@@ -35,6 +37,11 @@ class ProtoCompile(Command):
         print 'compiling: ' + target
         subprocess.call(cmdlines)
 
+    def _generate_codec(self, target):
+        dstfile = os.path.join(os.path.dirname(target), os.path.basename(target).replace('.', '_') + '.py')
+        print 'generating codec for %s' % dstfile
+        generate_codec_file(dstfile)
+
     def execute(self, args):
         '''执行过程
         '''
@@ -102,6 +109,8 @@ class ProtoCompile(Command):
                 c = Compiler(parser_class, generator_class, args.include_paths, subfix, extension)
                 print 'compiling %s' % args.target
                 c.compile(args.target)
+                if args.jce_codec:
+                    self._generate_codec(args.target)
 
             elif os.path.isdir(args.target):
                 args.include_paths.append(args.target)
@@ -122,6 +131,8 @@ class ProtoCompile(Command):
                         else:
                             print 'compiling %s' % filepath
                             c.compile(filepath)
+                            if args.jce_codec:
+                                self._generate_codec(filepath)
 
             else:
                 raise RuntimeError("target not found")
@@ -2,11 +2,15 @@
 """ioloop for underlayer socket connection
 """
 
+import heapq
+import itertools
+import math
 import os
 import select
 import socket
 import sys
 import threading
+import time
 import traceback
 import errno
 
@@ -20,6 +24,7 @@ class EnumSocketEvnet(object):
     E_RESET = 1 << 3
     E_TIMEOUT = 1 << 4
     E_CLOSE = 1 << 5
+    E_WRITABLE = 1 << 6
 
     E_ERROR = E_RESET | E_TIMEOUT
 
@@ -35,15 +40,48 @@ class EnumSocketEvnet(object):
         return cls._event_map.get(event, "unknown")
 
 
+class IOLoopTimer(object):
+    """a timer scheduled in ioloop, returned by IOLoopBase.call_at and IOLoopBase.call_later
+    """
+
+    def __init__(self, ioloop, deadline, callback, args, kwargs):
+        self._ioloop = ioloop
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        """cancel the timer, it takes no effect if the timer is already fired
+        """
+        if not self.cancelled:
+            self.cancelled = True
+            if self._ioloop:  # still in ioloop timer queue
+                self._ioloop._on_timer_cancelled()
+
+    def __call__(self):
+        self.callback(*self.args, **self.kwargs)
+
+    def __repr__(self):
+        return "<IOLoopTimer deadline=%s callback=%r>" % (self.deadline, self.callback)
+
+
 class IOLoopBase(object):
     """base io loop
     """
     _instance_lock = threading.Lock()
+    _timer_compact_threshold = 512
+    _ioloop_thread = None
 
     def __init__(self):
         self._lock = threading.Lock()
         self._fd_map = {}
         self._writing_fds = []
+        self._flushing_fds = set()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._cancelled_timer_count = 0
 
     def register_fd(self, fd, read_handler, connect_handler, err_handler):
         with self._lock:
@@ -62,6 +100,124 @@ class IOLoopBase(object):
     def remove_fd(self, fd):
         raise NotImplementedError
 
+    def watch_write(self, fd, handler):
+        """invoke handler in ioloop whenever fd is writable, until unwatch_write is called
+
+        :param fd: a connected fd registered in current ioloop
+        :param handler: writable handler without argument
+        """
+        if not hasattr(handler, "__call__"):
+            raise ValueError("handler=%r must be callable object" % handler)
+        with self._lock:
+            self._check_valid_fd(fd)
+            self._fd_map[fd][EnumSocketEvnet.E_WRITABLE] = handler
+            if fd in self._flushing_fds:
+                return
+            self._flushing_fds.add(fd)
+        self._update_write_interest(fd)
+
+    def unwatch_write(self, fd):
+        """stop watching writable event of fd
+        """
+        with self._lock:
+            if fd not in self._flushing_fds:
+                return
+            self._flushing_fds.discard(fd)
+        self._update_write_interest(fd)
+
+    def _update_write_interest(self, fd):
+        """notify underlayer poller that writable interest of fd is changed
+        """
+        pass
+
+    def in_ioloop_thread(self):
+        """is current thread the thread running ioloop
+        """
+        return threading.current_thread() is self._ioloop_thread
+
+    def call_at(self, deadline, callback, *args, **kwargs):
+        """run callback in ioloop at the given time
+
+        :param deadline: timestamp like time.time()
+        :type  deadline: float
+        :returns: timer object which could be cancelled
+        :rtype: IOLoopTimer
+        """
+        timer = IOLoopTimer(self, deadline, callback, args, kwargs)
+        with self._lock:
+            heapq.heappush(self._timers, (deadline, next(self._timer_seq), timer))
+            is_earliest = self._timers[0][2] is timer
+        if is_earliest:
+            self.wakeup()
+        return timer
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """run callback in ioloop after delay seconds
+
+        :param delay: delay in seconds
+        :type  delay: float
+        :returns: timer object which could be cancelled
+        :rtype: IOLoopTimer
+        """
+        return self.call_at(time.time() + delay, callback, *args, **kwargs)
+
+    def cancel_timer(self, timer):
+        """cancel a timer returned by call_at or call_later
+        """
+        timer.cancel()
+
+    def _on_timer_cancelled(self):
+        with self._lock:
+            self._cancelled_timer_count += 1
+            if (self._cancelled_timer_count > self._timer_compact_threshold and
+                self._cancelled_timer_count > len(self._timers) / 2):
+                self._timers = [it for it in self._timers if not it[2].cancelled]
+                heapq.heapify(self._timers)
+                self._cancelled_timer_count = 0
+
+    def _run_timers(self):
+        """run expired timers
+
+        :returns: seconds to wait for next timer, None if there is no timer
+        """
+        due_timers = []
+        timeout = None
+        with self._lock:
+            now = time.time()
+            while self._timers:
+                deadline, _, timer = self._timers[0]
+                if timer.cancelled:
+                    heapq.heappop(self._timers)
+                    self._cancelled_timer_count -= 1
+                elif deadline <= now:
+                    heapq.heappop(self._timers)
+                    timer._ioloop = None
+                    due_timers.append(timer)
+                else:
+                    timeout = deadline - now
+                    break
+        for timer in due_timers:
+            if timer.cancelled:
+                continue
+            try:
+                timer()
+            except:
+                stack = traceback.format_exc()
+                print("ioloop timer %r failed: %s" % (timer, stack))
+        if due_timers:
+            timeout = 0 if self._timers else None  # timers may be added by callbacks
+        return timeout
+
+    def wakeup(self):
+        """wakeup ioloop from pending on fds
+        """
+        pass
+
+    def get_load(self):
+        """get count of fds registered in current ioloop
+        """
+        return len(self._fd_map)
+
     def _check_valid_fd(self, fd):
         if fd not in self._fd_map:
             raise RuntimeError("fd=%r is not registered in current ioloop" % fd)
@@ -80,6 +236,12 @@ class IOLoopBase(object):
             raise RuntimeError("WRITE event of %s is not registered" % fd)
         handler()
 
+    def _handle_writable(self, fd):
+        self._check_valid_fd(fd)
+        handler = self._fd_map[fd].get(EnumSocketEvnet.E_WRITABLE)
+        if handler:
+            handler()
+
     def _handle_error(self, fd, e, stack):
         self._check_valid_fd(fd)
         handler = self._fd_map[fd].get(EnumSocketEvnet.E_ERROR)
@@ -99,14 +261,15 @@ class IOLoopBase(object):
         cls = type(self)
         attr = "_instance_%s" % cls.__name__
         with self._instance_lock:
-            setattr(cls, attr, None)
+            if getattr(cls, attr, None) is self:
+                setattr(cls, attr, None)
 
     @classmethod
     def instance(cls):
         attr = "_instance_%s" % cls.__name__
-        if not hasattr(cls, attr):
+        if getattr(cls, attr, None) is None:
             with cls._instance_lock:
-                if not hasattr(cls, attr):
+                if getattr(cls, attr, None) is None:
                     setattr(cls, attr, cls())
         return getattr(cls, attr)
 
@@ -155,6 +318,13 @@ class SelectIOLoop(IOLoopBase):
         IOLoopBase.register_fd(self, fd, read_handler, connect_handler, err_handler)
         self._socket_pair[1].send(EnumSocketPairCmd.REGISTER)  # wakeup select from pending
 
+    def wakeup(self):
+        if self._ioloop_thread and threading.current_thread() is not self._ioloop_thread:
+            self._socket_pair[1].send(EnumSocketPairCmd.WAKEUP)
+
+    def _update_write_interest(self, fd):
+        self.wakeup()
+
     def remove_fd(self, fd):
         with self._lock:
             self._removing_fds.append(fd)
@@ -179,6 +349,7 @@ class SelectIOLoop(IOLoopBase):
                     fd.close()
                 self._fd_map = {}
                 self._writing_fds = []
+                self._flushing_fds = set()
             self._ioloop_thread = None
             super(SelectIOLoop, self).stop()
 
@@ -190,18 +361,21 @@ class SelectIOLoop(IOLoopBase):
                         if fd not in self._fd_map:
                             break
                         del self._fd_map[fd]
+                        self._flushing_fds.discard(fd)
                         try:
                             self._writing_fds.remove(fd)
                         except ValueError:  # already removed
                             pass
                     self._removing_fds = []
+                    wfds = self._writing_fds + list(self._flushing_fds)
 
                 fds = self._fd_map.keys()
                 if not fds:
                     self._running = False
                     print("select ioloop exit normally")
                     break
-                r, w, x = select.select(fds, self._writing_fds, fds, None)
+                timeout = self._run_timers()
+                r, w, x = select.select(fds, wfds, fds, timeout)
                 self._handle_fd(r, w, x)
         except:
             stack = traceback.format_exc()
@@ -213,6 +387,10 @@ class SelectIOLoop(IOLoopBase):
     def _handle_fd(self, r, w, x):
         try:
             for active_fd in w:
+                if active_fd not in self._writing_fds:
+                    if active_fd in self._flushing_fds:
+                        self._handle_writable(active_fd)
+                    continue
                 err = active_fd.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
                 if 0 != err:
                     e = socket.error(err, os.strerror(err))
@@ -238,6 +416,167 @@ class SelectIOLoop(IOLoopBase):
             self._handle_error(active_fd, e, "socket exception from select")
 
 
+class PollIOLoop(SelectIOLoop):
+    """io loop via select.poll
+
+    fds are registered to the kernel incrementally when they are added or removed,
+    so there is no limit of FD_SETSIZE and no O(n) fd list rebuilding per wakeup
+    """
+    E_READ = getattr(select, "POLLIN", 0x001)
+    E_WRITE = getattr(select, "POLLOUT", 0x004)
+    E_ERROR = getattr(select, "POLLERR", 0x008) | getattr(select, "POLLHUP", 0x010)
+    E_INVALID = getattr(select, "POLLNVAL", 0x020)
+    _wakeup_on_modify = True  # registration changes take effect on next poll
+
+    def __init__(self):
+        self._poller = self._create_poller()
+        self._fileno_map = {}  # fileno -> fd
+        self._fd_filenos = {}  # fd -> fileno, fd may be closed before removing
+        super(PollIOLoop, self).__init__()
+
+    def _create_poller(self):
+        return select.poll()
+
+    def _poll(self, timeout):
+        """poll registered fds
+
+        :param timeout: timeout in seconds, None for infinite
+        :type  timeout: float
+        :returns: list of (fileno, events)
+        """
+        if timeout is not None:
+            timeout = int(math.ceil(timeout * 1000))
+        return self._poller.poll(timeout)
+
+    def register_fd(self, fd, read_handler, connect_handler, err_handler):
+        IOLoopBase.register_fd(self, fd, read_handler, connect_handler, err_handler)
+        fileno = fd.fileno()
+        with self._lock:
+            self._fileno_map[fileno] = fd
+            self._fd_filenos[fd] = fileno
+            self._poller.register(fileno, self.E_READ | self.E_WRITE | self.E_ERROR)
+        if self._wakeup_on_modify:
+            self.wakeup()
+
+    def remove_fd(self, fd):
+        with self._lock:
+            fileno = self._fd_filenos.pop(fd, None)
+            if fileno is None:
+                return
+            self._fd_map.pop(fd, None)
+            self._flushing_fds.discard(fd)
+            if self._fileno_map.get(fileno) is fd:
+                del self._fileno_map[fileno]
+            try:
+                self._writing_fds.remove(fd)
+            except ValueError:  # already connected
+                pass
+            try:
+                self._poller.unregister(fileno)
+            except (IOError, OSError, KeyError, ValueError):  # fd is already closed
+                pass
+        if self._wakeup_on_modify:
+            self.wakeup()
+
+    def _get_event_mask(self, fd, connecting):
+        mask = self.E_READ | self.E_ERROR
+        if connecting or fd in self._flushing_fds:
+            mask |= self.E_WRITE
+        return mask
+
+    def _update_write_interest(self, fd):
+        with self._lock:
+            fileno = self._fd_filenos.get(fd)
+            if fileno is None:
+                return
+            self._poller.modify(fileno, self._get_event_mask(fd, fd in self._writing_fds))
+        if self._wakeup_on_modify:
+            self.wakeup()
+
+    def _handle_connect(self, fd):
+        with self._lock:
+            fileno = self._fd_filenos.get(fd)
+            if fileno is not None:
+                self._poller.modify(fileno, self._get_event_mask(fd, False))
+        IOLoopBase._handle_connect(self, fd)
+
+    def stop(self):
+        if self._ioloop_thread:
+            super(PollIOLoop, self).stop()
+            with self._lock:
+                self._fileno_map = {}
+                self._fd_filenos = {}
+            if hasattr(self._poller, "close"):
+                self._poller.close()
+
+    def _ioloop_thread_func(self):
+        try:
+            while self._running:
+                if not self._fd_map:
+                    self._running = False
+                    print("%s exit normally" % type(self).__name__)
+                    break
+                timeout = self._run_timers()
+                try:
+                    events = self._poll(timeout)
+                except (IOError, OSError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fileno, event in events:
+                    fd = self._fileno_map.get(fileno)
+                    if fd is not None:  # removed by former event handler
+                        self._handle_event(fd, event)
+        except:
+            stack = traceback.format_exc()
+            print("%s unexpectedly exited:\n%s" % (type(self).__name__, stack))
+            for fd in self._fd_map.copy():
+                fd.close()
+            self._fd_map = {}
+
+    def _handle_event(self, fd, event):
+        try:
+            if event & self.E_INVALID:
+                self.remove_fd(fd)
+                return
+            if fd in self._writing_fds and event & (self.E_WRITE | self.E_ERROR):
+                err = fd.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if 0 != err:
+                    e = socket.error(err, os.strerror(err))
+                    self._handle_error(fd, e, "socket level error")
+                    return
+                self._handle_connect(fd)
+            elif event & self.E_WRITE and fd in self._flushing_fds:
+                self._handle_writable(fd)
+            if event & (self.E_READ | self.E_ERROR) and fd in self._fd_map:
+                self._handle_read(fd)  # recv reports the pending error or peer closing
+        except socket.error as e:
+            if e.args[0] == errno.EBADF:
+                pass  # socket unexpectedly closed
+            else:
+                self._handle_error(fd, e, traceback.format_exc())
+        except Exception as e:
+            self._handle_error(fd, e, traceback.format_exc())
+
+
+class EpollIOLoop(PollIOLoop):
+    """io loop via select.epoll, only available on Linux
+    """
+    E_READ = getattr(select, "EPOLLIN", 0x001)
+    E_WRITE = getattr(select, "EPOLLOUT", 0x004)
+    E_ERROR = getattr(select, "EPOLLERR", 0x008) | getattr(select, "EPOLLHUP", 0x010)
+    E_INVALID = 0
+    _wakeup_on_modify = False  # epoll registration takes effect immediately
+
+    def _create_poller(self):
+        return select.epoll()
+
+    def _poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return self._poller.poll(timeout)
+
+
 if "win32" in sys.platform:
 
     def socketpair():
@@ -252,4 +591,83 @@ if "win32" in sys.platform:
     DEFAULT_IOLOOP_CLS = SelectIOLoop
 else:
     from socket import socketpair
-    DEFAULT_IOLOOP_CLS = SelectIOLoop
+    if hasattr(select, "epoll"):
+        DEFAULT_IOLOOP_CLS = EpollIOLoop
+    elif hasattr(select, "poll") and sys.platform != "darwin":  # poll is broken on some darwin versions
+        DEFAULT_IOLOOP_CLS = PollIOLoop
+    else:
+        DEFAULT_IOLOOP_CLS = SelectIOLoop
+
+
+class EnumIOLoopPolicy(object):
+    HASH = "hash"
+    LEAST_LOAD = "least_load"
+
+
+class IOLoopGroup(object):
+    """a group of ioloops each running in its own thread, connections are
+    assigned to ioloops by hash of an affinity key or by least load, connections without
+    affinity key are always assigned by least load
+    """
+    _instance_lock = threading.Lock()
+    _instance = None
+
+    def __init__(self, size=1, policy=EnumIOLoopPolicy.HASH, ioloop_cls=None):
+        """construct an ioloop group
+
+        :param size: count of ioloops
+        :type  size: int
+        :param policy: policy of assigning ioloop, see EnumIOLoopPolicy
+        :type  policy: str
+        :param ioloop_cls: ioloop class, DEFAULT_IOLOOP_CLS is used by default
+        :type  ioloop_cls: type
+        """
+        if size < 1:
+            raise ValueError("ioloop group size=%r must be positive" % size)
+        if policy not in (EnumIOLoopPolicy.HASH, EnumIOLoopPolicy.LEAST_LOAD):
+            raise ValueError("unsupported ioloop group policy: %r" % policy)
+        self._policy = policy
+        self._ioloop_cls = ioloop_cls or DEFAULT_IOLOOP_CLS
+        if size == 1:
+            self._ioloops = [self._ioloop_cls.instance()]
+        else:
+            self._ioloops = [self._ioloop_cls() for _ in range(size)]
+
+    @property
+    def size(self):
+        return len(self._ioloops)
+
+    @property
+    def ioloops(self):
+        return self._ioloops[:]
+
+    def get_ioloop(self, key=None):
+        """get an ioloop for connection
+
+        :param key: affinity key, connections with the same key share the same ioloop
+        :type  key: hashable object
+        """
+        if len(self._ioloops) == 1:
+            return self._ioloops[0]
+        if key is None or self._policy == EnumIOLoopPolicy.LEAST_LOAD:
+            return min(self._ioloops, key=lambda x: x.get_load())
+        return self._ioloops[hash(key) % len(self._ioloops)]
+
+    def stop(self):
+        for ioloop in self._ioloops:
+            ioloop.stop()
+        with self._instance_lock:
+            if IOLoopGroup._instance is self:
+                IOLoopGroup._instance = None
+
+    @classmethod
+    def instance(cls):
+        """get the global ioloop group configured by QT4S_IOLOOP_POOL_SIZE and QT4S_IOLOOP_POOL_POLICY
+        """
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    from testbase.conf import settings
+                    cls._instance = cls(settings.QT4S_IOLOOP_POOL_SIZE,
+                                        settings.QT4S_IOLOOP_POOL_POLICY)
+        return cls._instance
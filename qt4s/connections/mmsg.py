@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""batched datagram io with recvmmsg/sendmmsg, only IPv4 sockets on linux are supported
+"""
+
+import ctypes
+import os
+import socket
+import struct
+import sys
+
+MSG_DONTWAIT = 0x40
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_uint32),
+                ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "recvmmsg") or not hasattr(libc, "sendmmsg"):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+HAS_MMSG = _libc is not None
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise socket.error(err, os.strerror(err))
+
+
+class DatagramReceiver(object):
+    """receive at most batch_size datagrams with one recvmmsg call, buffers are reused between calls
+    """
+
+    def __init__(self, batch_size=32, buff_size=8192):
+        self._batch_size = batch_size
+        self._buffs = [ctypes.create_string_buffer(buff_size) for _ in range(batch_size)]
+        self._addrs = (_SockAddrIn * batch_size)()
+        self._iovecs = (_IOVec * batch_size)()
+        self._msgs = (_MMsgHdr * batch_size)()
+        for i in range(batch_size):
+            self._iovecs[i].iov_base = ctypes.cast(self._buffs[i], ctypes.c_void_p)
+            self._iovecs[i].iov_len = buff_size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(ctypes.pointer(self._addrs[i]), ctypes.c_void_p)
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def recv(self, sock):
+        """receive datagrams without blocking
+
+        :returns: list of (data, (host, port))
+        """
+        for i in range(self._batch_size):
+            self._msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+        count = _libc.recvmmsg(sock.fileno(), self._msgs, self._batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            _raise_errno()
+        datagrams = []
+        for i in range(count):
+            data = ctypes.string_at(self._buffs[i], self._msgs[i].msg_len)
+            addr = self._addrs[i]
+            host = socket.inet_ntoa(struct.pack("=I", addr.sin_addr))
+            datagrams.append((data, (host, socket.ntohs(addr.sin_port))))
+        return datagrams
+
+
+def sendmmsg(sock, datagrams, address):
+    """send datagrams to the same address with one sendmmsg call
+
+    :returns: number of datagrams sent
+    """
+    count = len(datagrams)
+    if not count:
+        return 0
+    addr = _SockAddrIn()
+    addr.sin_family = socket.AF_INET
+    addr.sin_port = socket.htons(address[1])
+    addr.sin_addr, = struct.unpack("=I", socket.inet_aton(socket.gethostbyname(address[0])))
+    buffs = [ctypes.create_string_buffer(data, len(data)) for data in datagrams]
+    iovecs = (_IOVec * count)()
+    msgs = (_MMsgHdr * count)()
+    for i, buff in enumerate(buffs):
+        iovecs[i].iov_base = ctypes.cast(buff, ctypes.c_void_p)
+        iovecs[i].iov_len = len(datagrams[i])
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.cast(ctypes.pointer(addr), ctypes.c_void_p)
+        hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+    sent = _libc.sendmmsg(sock.fileno(), msgs, count, 0)
+    if sent < 0:
+        _raise_errno()
+    return sent
@@ -4,13 +4,17 @@
 
 from __future__ import print_function
 
+import collections
 import errno
+import itertools
 import os
 import socket
 import threading
+import time
 
 from qt4s.connections.base import ConnectionBase
-from qt4s.connections.ioloop import DEFAULT_IOLOOP_CLS
+from qt4s.connections import mmsg
+from qt4s.connections.ioloop import IOLoopGroup
 from qt4s.network.proxy import NullProxy
 from qt4s.network.rules import get_proxy
 
@@ -24,7 +28,91 @@ if hasattr(errno, "WSAEWOULDBLOCK"):
 else:
     E_WOULDBLOCK = ()
 
+E_AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK) + E_WOULDBLOCK
+
 DEFAULT_BUFF_SIZE = 8192
+MAX_GATHER_CHUNKS = 64
+MAX_RECV_DATAGRAMS = 256  # max datagrams received in one readable event
+
+
+class SocketBufferOverflowError(Exception):
+    """pending data to send exceeds high water mark for too long
+    """
+    pass
+
+
+class ReceiveBuffer(object):
+    """growable receive buffer filled by recv_into, data is moved only when space is needed,
+    the buffer shrinks back to its initial capacity once grown data is consumed
+    """
+
+    def __init__(self, capacity=DEFAULT_BUFF_SIZE):
+        self._init_capacity = capacity
+        self._buf = bytearray(capacity)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def capacity(self):
+        return len(self._buf)
+
+    def reserve(self, size):
+        """make sure there is at least size bytes free space at the tail
+        """
+        if len(self._buf) - self._end >= size:
+            return
+        data_size = self._end - self._start
+        if len(self._buf) - data_size >= size:  # compact
+            self._buf[:data_size] = self._buf[self._start:self._end]
+        else:  # grow, copy into a new buffer in case that views are still referenced
+            buf = bytearray(max(len(self._buf) * 2, data_size + size))
+            buf[:data_size] = memoryview(self._buf)[self._start:self._end]
+            self._buf = buf
+        self._start = 0
+        self._end = data_size
+
+    def recv_from(self, sock, size=DEFAULT_BUFF_SIZE):
+        """receive at most size bytes from sock into buffer
+
+        :returns: received size, 0 if peer is closed
+        """
+        self.reserve(size)
+        nbytes = sock.recv_into(memoryview(self._buf)[self._end:], size)
+        self._end += nbytes
+        return nbytes
+
+    def write(self, data):
+        self.reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def peek(self, size=None):
+        """get a view of buffered data without consuming it,
+        the view is only valid before the buffer is filled again
+        """
+        end = self._end if size is None else min(self._end, self._start + size)
+        return memoryview(self._buf)[self._start:end]
+
+    def consume(self, size):
+        """drop size bytes from the head
+        """
+        if size > self._end - self._start:
+            raise ValueError("consume %s bytes from buffer with %s bytes" % (size, self._end - self._start))
+        self._start += size
+        if self._start == self._end:  # rewind for free
+            self._start = self._end = 0
+            if len(self._buf) > self._init_capacity:  # release capacity grown for large frames
+                self._buf = bytearray(self._init_capacity)
+
+    def read(self, size=None):
+        """get and consume data as bytes
+        """
+        data = self.peek(size).tobytes()
+        self.consume(len(data))
+        return data
 
 
 class EnumConnType(object):
@@ -77,6 +165,8 @@ class SocketConn(ConnectionBase):
     """socket connection
     """
     ioloop_cls = None
+    write_high_water_mark = 4 * 1024 * 1024  # producer is blocked when pending data exceeds it
+    write_block_timeout = 10  # raise SocketBufferOverflowError if blocked longer, 0 to raise at once
 
     def __init__(self, address, callback):
         super(SocketConn, self).__init__(address)
@@ -85,10 +175,19 @@ class SocketConn(ConnectionBase):
         self._port = address["port"]
         self._callback = callback
         self._sock = None
-        self._ioloop = DEFAULT_IOLOOP_CLS.instance()
+        if self.ioloop_cls:
+            self._ioloop = self.ioloop_cls.instance()
+        else:
+            # connections without affinity key are assigned to the least loaded ioloop
+            self._ioloop = IOLoopGroup.instance().get_ioloop(address.get("affinity_key", None))
         self._closed = False
-        self._buf = []
+        self._datagrams = collections.deque()
+        self._datagram_receiver = None
+        self._recv_buf = None  # allocated on first use of tcp connection
         self._lock = threading.Lock()
+        self._write_buf = collections.deque()
+        self._write_buf_size = 0
+        self._write_cond = threading.Condition(threading.Lock())
 
     @property
     def host(self):
@@ -106,6 +205,18 @@ class SocketConn(ConnectionBase):
     def fd(self):
         return self._sock
 
+    @property
+    def ioloop(self):
+        return self._ioloop
+
+    @property
+    def recv_buffer(self):
+        """receive buffer of tcp connection, which should only be accessed in callback of ioloop
+        """
+        if self._recv_buf is None:
+            self._recv_buf = ReceiveBuffer()
+        return self._recv_buf
+
     def get_proxy(self):
         conditions = {
             "proto" : self.socket_type,
@@ -136,31 +247,108 @@ class SocketConn(ConnectionBase):
             self._sock.setblocking(False)
         self.register()
 
+    @property
+    def pending_size(self):
+        """size of data queued but not sent yet
+        """
+        return self._write_buf_size
+
     def send(self, data):
         self._callback.on_send(data)
         if self.socket_type == EnumConnType.TCP:
-            sent_size = 0
-            data_size = len(data)
-            while sent_size < data_size:
-                sent_size += self._sock.send(data[sent_size:])
+            with self._write_cond:
+                if self._closed:
+                    raise socket.error(errno.EPIPE, "send data to a closed connection")
+                self._write_buf.append(data)
+                self._write_buf_size += len(data)
+                if len(self._write_buf) == 1:  # nothing pending, try sending directly
+                    self._flush()
+                if self._write_buf:
+                    self._ioloop.watch_write(self._sock, self.on_writable)
+                    self._wait_for_draining()
         else:
             self._sock.sendto(data, 0, (self._host, self._port))
 
+    def _flush(self):
+        """send queued data until socket buffer is full, write lock must be held
+        """
+        while self._write_buf:
+            try:
+                if len(self._write_buf) > 1 and hasattr(self._sock, "sendmsg"):
+                    sent_size = self._sock.sendmsg(list(itertools.islice(self._write_buf, MAX_GATHER_CHUNKS)))
+                else:
+                    sent_size = self._sock.send(self._write_buf[0])
+            except socket.error as e:
+                if get_errno(e) in E_AGAIN:
+                    break
+                raise
+            self._write_buf_size -= sent_size
+            while sent_size:
+                chunk_size = len(self._write_buf[0])
+                if chunk_size <= sent_size:
+                    self._write_buf.popleft()
+                    sent_size -= chunk_size
+                else:
+                    self._write_buf[0] = memoryview(self._write_buf[0])[sent_size:]
+                    sent_size = 0
+
+    def _wait_for_draining(self):
+        """block producer while pending data exceeds high water mark, write lock must be held
+        """
+        if self._write_buf_size <= self.write_high_water_mark:
+            return
+        if self._ioloop.in_ioloop_thread():  # blocking ioloop thread would never drain
+            return
+        deadline = time.time() + self.write_block_timeout
+        while self._write_buf_size > self.write_high_water_mark and not self._closed:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise SocketBufferOverflowError("%s bytes pending to send to %s:%s over %ss" % (self._write_buf_size,
+                                                                                          self._host, self._port,
+                                                                                          self.write_block_timeout))
+            self._write_cond.wait(timeout)
+        if self._closed:
+            raise socket.error(errno.EPIPE, "connection closed while sending data")
+
+    def on_writable(self):
+        with self._write_cond:
+            try:
+                self._flush()
+            finally:
+                self._write_cond.notify_all()
+            if not self._write_buf:
+                self._ioloop.unwatch_write(self._sock)
+
     def read(self):
         with self._lock:
             if self.socket_type == EnumConnType.TCP:
-                data = "".join(self._buf)
-                self._buf = []
+                data = self.recv_buffer.read()
             else:
-                data = self._buf[0]
-                self._buf = self._buf[1:]
+                data = self._datagrams.popleft()
         return data
 
-    def close(self):
-        if not self._closed:
+    def _mark_closed(self):
+        """stop sending, pending data is dropped and blocked producers are woken up
+
+        :returns: False if connection is already closed
+        """
+        with self._write_cond:
+            if self._closed:
+                return False
             self._closed = True
+            self._write_buf.clear()
+            self._write_buf_size = 0
+            self._write_cond.notify_all()
+        return True
+
+    def close(self):
+        was_open = self._mark_closed()
+        if self._sock is None:  # never connected
+            return
+        if was_open:
             self._ioloop.remove_fd(self._sock)
-            self._sock.close()
+        self._sock.close()  # socket is still open if peer closed the connection
+        if was_open:
             self._callback.on_closed()
 
     def on_connected(self):
@@ -168,22 +356,68 @@ class SocketConn(ConnectionBase):
 
     def on_recv(self):
         if self.socket_type == EnumConnType.TCP:
-            data = self.fd.recv(DEFAULT_BUFF_SIZE)
-            if data:
-                with self._lock:
-                    self._buf.append(data)
+            with self._lock:
+                nbytes = self.recv_buffer.recv_from(self.fd)
+            if nbytes:
                 self._callback.on_recv()
             else:
+                self._mark_closed()
                 self._ioloop.remove_fd(self._sock)
                 self._callback.on_closed()
         else:
-            data, addr = self.fd.recvfrom(DEFAULT_BUFF_SIZE)
+            for _ in range(self._recv_datagrams()):
+                self._callback.on_recv()
+
+    def _recv_datagrams(self):
+        """receive datagrams until socket is drained
+
+        :returns: number of received datagrams
+        """
+        count = 0
+        while count < MAX_RECV_DATAGRAMS:
+            try:
+                if mmsg.HAS_MMSG and self._sock.family == socket.AF_INET:
+                    if self._datagram_receiver is None:
+                        self._datagram_receiver = mmsg.DatagramReceiver(buff_size=DEFAULT_BUFF_SIZE)
+                    datagrams = self._datagram_receiver.recv(self._sock)
+                else:
+                    datagrams = [self._sock.recvfrom(DEFAULT_BUFF_SIZE)]
+            except socket.error as e:
+                if get_errno(e) in E_AGAIN:
+                    break
+                raise
             with self._lock:
-                self._buf.append((data, addr))
-            self._callback.on_recv()
+                self._datagrams.extend(datagrams)
+            count += len(datagrams)
+            if self._datagram_receiver and len(datagrams) < self._datagram_receiver.batch_size:
+                break  # already drained
+        return count
+
+    def send_batch(self, datagrams):
+        """send several datagrams in one system call if possible, only for udp connection
+
+        :param datagrams: list of data to send
+        :type  datagrams: list
+        """
+        if self.socket_type != EnumConnType.UDP:
+            raise ValueError("batch sending is only for udp connection")
+        for data in datagrams:
+            self._callback.on_send(data)
+        address = (self._host, self._port)
+        if mmsg.HAS_MMSG and self._sock.family == socket.AF_INET:
+            sent = 0
+            while sent < len(datagrams):
+                sent += mmsg.sendmmsg(self._sock, datagrams[sent:], address)
+        else:
+            for data in datagrams:
+                self._sock.sendto(data, 0, address)
 
     def on_error(self, e, stack):
         if not e:
             err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
             e = socket.error(err, os.strerror(err))
+        with self._write_cond:
+            self._write_buf.clear()
+            self._write_buf_size = 0
+            self._write_cond.notify_all()
         self._callback.on_error(e, stack)
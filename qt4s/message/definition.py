@@ -3,7 +3,7 @@
 消息定义模块
 '''
 
-import fnmatch
+import array
 import json
 import pprint
 import types
@@ -60,9 +60,24 @@ class _UninitializedType(object):
 Uninitialized = _UninitializedType()
 
 
+class LazyValue(object):
+    '''延迟解码的值，由序列化器在反序列化时生成，首次访问所在的域时才解码
+    '''
+
+    def __init__(self, loader, *args):
+        self._loader = loader
+        self._args = args
+
+    def load(self):
+        '''解码为Python基本类型
+        '''
+        return self._loader(*self._args)
+
+
 class StructTypeBase(object):
-    '''结构类型基类
+    '''结构类型基类，标量类型都定义了__slots__，没有实例字典
     '''
+    __slots__ = ('__msg',)
     _msgclass = None
 
     def __init__(self, params, message):
@@ -149,6 +164,7 @@ class StructTypeBase(object):
 class Null(StructTypeBase):
     '''空类型
     '''
+    __slots__ = ()
 
     def __init__(self):
         super(Null, self).__init__({'__sugar':'sugar'}, None)
@@ -174,6 +190,7 @@ class Null(StructTypeBase):
 class Number(StructTypeBase):
     '''数值（包括整数型和浮点数）
     '''
+    __slots__ = ('_value',)
 
     def __init__(self, params, message):
         self._value = Uninitialized
@@ -210,6 +227,7 @@ class Number(StructTypeBase):
 class Float(Number):
     '''浮点数类型
     '''
+    __slots__ = ()
 
     def _check_type(self, value, field=None):
         '''检查赋值类型
@@ -227,12 +245,13 @@ class Float(Number):
 class Double(Float):
     '''双浮点数类型
     '''
-    pass
+    __slots__ = ()
 
 
 class Integer(Number):
     '''整型数
     '''
+    __slots__ = ()
 
     def _check_type(self, value, field=None):
         '''检查赋值类型
@@ -254,6 +273,7 @@ class Integer(Number):
 class Int8(Integer):
     '''8位有符号整型数
     '''
+    __slots__ = ()
     MAX = int(2 ** 7 - 1)
     MIN = int(-2 ** 7)
 
@@ -270,6 +290,7 @@ class Int8(Integer):
 class Uint8(Integer):
     '''8位无符号整型数
     '''
+    __slots__ = ()
     MAX = int(2 ** 8)
     MIN = 0
 
@@ -288,6 +309,7 @@ class Uint8(Integer):
 class Int16(Integer):
     '''16位有符号整型数
     '''
+    __slots__ = ()
     MAX = int(2 ** 15 - 1)
     MIN = int(-2 ** 15)
 
@@ -304,6 +326,7 @@ class Int16(Integer):
 class Uint16(Integer):
     '''16位无符号整型数
     '''
+    __slots__ = ()
     MAX = int(2 ** 16)
     MIN = 0
 
@@ -320,6 +343,7 @@ class Uint16(Integer):
 class Int32(Integer):
     '''32位有符号整型数
     '''
+    __slots__ = ()
     MAX = int(2 ** 31 - 1)
     MIN = int(-2 ** 31)
 
@@ -336,6 +360,7 @@ class Int32(Integer):
 class Uint32(Integer):
     '''32位无符号整型数
     '''
+    __slots__ = ()
     MAX = int(2 ** 32)
     MIN = 0
 
@@ -352,6 +377,7 @@ class Uint32(Integer):
 class Long(Number):
     '''整型数
     '''
+    __slots__ = ()
 
     def _check_type(self, value, field=None):
         '''检查赋值类型
@@ -372,6 +398,7 @@ class Long(Number):
 class Int64(Long):
     '''64位有符号整型数
     '''
+    __slots__ = ()
     MAX = int(2 ** 63 - 1)
     MIN = int(-2 ** 63)
 
@@ -388,6 +415,7 @@ class Int64(Long):
 class Uint64(Long):
     '''64位无符号整型数
     '''
+    __slots__ = ()
     MAX = int(2 ** 64)
     MIN = 0
 
@@ -404,6 +432,7 @@ class Uint64(Long):
 class String(StructTypeBase):
     '''字符串类型
     '''
+    __slots__ = ('_value', '_encoding', '_as_buffer', '_byte_size')
 
     def __init__(self, params, message):
         self._value = Uninitialized
@@ -493,6 +522,7 @@ class String(StructTypeBase):
 class Buffer(String):
     '''缓冲区类型
     '''
+    __slots__ = ()
 
     def __init__(self, params, message):
         params['buffer'] = True
@@ -502,6 +532,7 @@ class Buffer(String):
 class Bool(StructTypeBase):
     '''布尔类型
     '''
+    __slots__ = ('_value',)
 
     def __init__(self, params, message):
         self._value = Uninitialized
@@ -557,8 +588,8 @@ class ArrayBase(CompositeType):
         self._arr_size = params.get('array_size', None)
         super(ArrayBase, self).__init__(params, message)
 
-    def _check_and_process_type(self, listvalue, field=None):
-        '''检查赋值类型
+    def _check_list(self, listvalue, field=None):
+        '''检查赋值类型和数组长度
         '''
         if listvalue is None:
             listvalue = []
@@ -574,8 +605,13 @@ class ArrayBase(CompositeType):
             delta = self._arr_size - len(listvalue)
             if delta:
                 raise Exception("to do")
+        return listvalue
+
+    def _check_and_process_type(self, listvalue, field=None):
+        '''检查赋值类型
+        '''
         dlist = []
-        for it in listvalue:
+        for it in self._check_list(listvalue, field):
             dlist.append(self._process_elements_while_assignment(it, self._child_params))
         return dlist
 
@@ -633,6 +669,11 @@ class ArrayBase(CompositeType):
     def __len__(self):
         return len(self._dlist)
 
+    def get_element_structs(self):
+        '''获取元素的结构对象列表，供序列化器不经过reduce直接序列化
+        '''
+        return self._dlist
+
     def __getitem__(self, idx):
         return self._dlist[idx].to_use()
 
@@ -679,6 +720,147 @@ class ArrayBase(CompositeType):
         self._dlist.insert(idx, self._process_elements_while_assignment(obj, self._child_params))
 
 
+class NumericArrayBase(ArrayBase):
+    '''数值数组类型基类，元素以数值形式连续保存在array.array中，不创建元素的结构对象
+
+    数值无法保存到array.array中时（例如Uint64的2**64、Float的整数和字符串），退化为使用列表保存数值
+    '''
+    storage_typecode = None  # array.array的类型码，为None时使用列表保存
+    storage_value_types = frozenset()  # 可以直接保存到array.array中的数值类型
+    storage_range = None  # 存储类型的表示范围宽于元素类型时，元素类型的取值范围
+
+    def __init__(self, params, message):
+        super(NumericArrayBase, self).__init__(params, message)
+        self._dlist = self._create_storage([])
+
+    def _create_storage(self, values):
+        '''检查数值并创建存储，类型和范围对整个数组一次检查，不通过时逐个元素检查以给出原有的错误信息
+        '''
+        typecode = self.storage_typecode
+        if typecode is not None:
+            storage = None
+            if isinstance(values, array.array) and values.typecode == typecode:
+                storage = values
+            elif set(map(type, values)) <= self.storage_value_types:
+                try:
+                    storage = array.array(typecode, values)
+                except OverflowError:
+                    pass
+            if storage is not None and self._in_range(storage):
+                return storage
+        checker = self.element_struct.create(self._child_params)
+        for it in values:
+            checker.from_assignment(it)
+        return list(values)
+
+    def _in_range(self, storage):
+        '''检查array.array中的数值是否都在元素类型的取值范围内
+        '''
+        if self.storage_range is None or not storage:
+            return True
+        return self.storage_range[0] <= min(storage) and max(storage) <= self.storage_range[1]
+
+    def _prepare_element(self, value):
+        '''检查要加入数组的元素，数值无法保存到array.array中时存储退化为列表
+        '''
+        self.element_struct.create(self._child_params).from_assignment(value)
+        if isinstance(self._dlist, array.array):
+            try:
+                if type(value) not in self.storage_value_types:
+                    raise TypeError()
+                array.array(self._dlist.typecode, [value])
+            except (OverflowError, TypeError):
+                self._dlist = list(self._dlist)
+
+    def _check_and_process_type(self, listvalue, field=None):
+        '''检查赋值类型
+        '''
+        return self._create_storage(self._check_list(listvalue, field))
+
+    def construct(self, listvalue, field=None):
+        '''作为组合结构类型的成员时，从字典初始化时调用，也接受array.array
+        '''
+        value_type = type(listvalue)
+        if value_type != types.ListType and value_type != array.array:
+            excs = 'required list type, not %s' % str(value_type.__name__)
+            if field:
+                excs = 'field "%s" %s' % (field.name, excs)
+            raise ValueError(excs)
+        self._dlist = self._create_storage(listvalue)
+
+    def reduce(self, allow_uninit_field=False):
+        '''作为组合结构类型的成员时，转换为字典时调用
+        '''
+        return list(self._dlist)
+
+    def get_values(self):
+        '''获取保存数值的array.array或列表，供序列化器直接使用
+        '''
+        return self._dlist
+
+    def get_element_structs(self):
+        '''获取元素的结构对象列表，供序列化器不经过reduce直接序列化
+        '''
+        return [self._process_elements_while_assignment(it, self._child_params) for it in self._dlist]
+
+    def __getitem__(self, idx):
+        return self._dlist[idx]
+
+    def __setitem__(self, idx, obj):
+        self._prepare_element(obj)
+        self._dlist[idx] = obj
+
+    def __iter__(self):
+        return iter(self._dlist)
+
+    def __contains__(self, item):
+        return item in self._dlist
+
+    def __eq__(self, obj):
+        if isinstance(obj, NumericArrayBase) and obj.element_struct == self.element_struct:
+            return list(obj._dlist) == list(self._dlist)
+        elif isinstance(obj, ArrayBase):
+            return self.get_element_structs() == obj.get_element_structs()
+        elif isinstance(obj, types.ListType):
+            return obj == list(self._dlist)
+        else:
+            return False
+
+    def append(self, obj):
+        if self._arr_size:
+            raise RuntimeError("fixed size array could not append")
+        self._prepare_element(obj)
+        self._dlist.append(obj)
+
+    def add(self):
+        raise TypeError("numeric array could not add element structure, use append instead")
+
+    def insert(self, idx, obj):
+        if self._arr_size:
+            raise RuntimeError("fixed size array could not insert")
+        self._prepare_element(obj)
+        self._dlist.insert(idx, obj)
+
+
+_LONG_IS_INT64 = array.array('l').itemsize == 8
+_INT_VALUE_TYPES = frozenset([types.IntType, types.LongType])
+_FLOAT_VALUE_TYPES = frozenset([types.FloatType])
+
+# 元素类型 => (array.array类型码, 可以直接保存的数值类型, 元素类型的取值范围)
+_NUMERIC_ARRAY_STORAGES = {
+    Int8: ('b', _INT_VALUE_TYPES, None),
+    Uint8: ('h', _INT_VALUE_TYPES, (-0x100, Uint8.MAX)),
+    Int16: ('h', _INT_VALUE_TYPES, None),
+    Uint16: ('i', _INT_VALUE_TYPES, (Uint16.MIN, Uint16.MAX)),
+    Int32: ('i', _INT_VALUE_TYPES, None),
+    Uint32: ('l' if _LONG_IS_INT64 else None, _INT_VALUE_TYPES, (Uint32.MIN, Uint32.MAX)),
+    Int64: ('l' if _LONG_IS_INT64 else None, _INT_VALUE_TYPES, None),
+    Uint64: ('L' if _LONG_IS_INT64 else None, _INT_VALUE_TYPES, None),
+    Float: ('d', _FLOAT_VALUE_TYPES, None),
+    Double: ('d', _FLOAT_VALUE_TYPES, None),
+}
+
+
 def _get_struct_type(datatype):
     '''获取消息类型或结构类型对应的结构类型
     '''
@@ -704,7 +886,9 @@ def Array(datatype):
     if array_type:
         return array_type
 
-    class _ArrayType(ArrayBase):
+    storage = _NUMERIC_ARRAY_STORAGES.get(item_datatype, None)
+
+    class _ArrayType(NumericArrayBase if storage else ArrayBase):
         '''生成的类型
         '''
         element_struct = item_datatype
@@ -723,6 +907,8 @@ def Array(datatype):
             obj.construct(value)
             return obj
 
+    if storage:
+        _ArrayType.storage_typecode, _ArrayType.storage_value_types, _ArrayType.storage_range = storage
     _array_type_cache[item_datatype] = _ArrayType
     return _ArrayType
 
@@ -1051,8 +1237,11 @@ class Dict(CompositeType):
 
     @classmethod
     def get_fields(cls):
-        '''获取定义的域列表
+        '''获取定义的域列表，结果按类缓存，不可修改
         '''
+        fields = cls.__dict__.get('_all_fields_')
+        if fields is not None and fields[0] is cls._fields_:
+            return fields[1]
         fields = []
         for it in cls.__bases__:
             if issubclass(it, Dict) and it != Dict:
@@ -1060,12 +1249,36 @@ class Dict(CompositeType):
                     continue
                 fields += it.get_fields()
         fields += cls._fields_
+        setattr(cls, '_all_fields_', (cls._fields_, fields))
         return fields
 
+    @classmethod
+    def get_field_index(cls):
+        '''获取域名称和显示名称到域定义的索引，结果按类缓存，不可修改
+        '''
+        return cls._get_field_table()[2]
+
+    @classmethod
+    def _get_field_table(cls):
+        '''获取域表(_fields_, 域元组, 名称索引, 可直接按属性名访问的域)，按类缓存
+        '''
+        table = cls.__dict__.get('_field_table_')
+        if table is None or table[0] is not cls._fields_:
+            fields = tuple(cls.get_fields())
+            index = {}
+            for field in reversed(fields):  # 同名时靠前的域优先
+                index[field.display] = field
+                index[field.name] = field
+            index.pop(None, None)
+            attr_fields = dict((name, field) for name, field in index.items() if not hasattr(cls, name))
+            table = (cls._fields_, fields, index, attr_fields)
+            setattr(cls, '_field_table_', table)
+        return table
+
     def _get_fields(self):
         '''获取定义的域列表
         '''
-        return type(self).get_fields()
+        return type(self)._get_field_table()[1]
 
     def _init_fields(self, args, kwargs):
         '''初始化
@@ -1110,11 +1323,11 @@ class Dict(CompositeType):
     def construct(self, dict_data, field=None):
         '''从Python基本类型构造
         '''
-        d = dict_data.copy()
+        consumed = 0
         for field in self._get_fields():
             try:
-                value = d[field.name]
-                del d[field.name]
+                value = dict_data[field.name]
+                consumed += 1
             except KeyError:
                 if not field.has_default:
                     if field.required:
@@ -1122,6 +1335,8 @@ class Dict(CompositeType):
             else:
                 if value is None and field.allow_none:
                     self.__ddict[field.name] = Null()
+                elif isinstance(value, LazyValue):
+                    self.__ddict[field.name] = value
                 else:
                     if issubclass(field.type, StructTypeBase):
                         obj = field.type.create(field.params)
@@ -1129,15 +1344,50 @@ class Dict(CompositeType):
                     else:
                         obj = value
                     self.__ddict[field.name] = obj
-        if d:
+        if consumed != len(dict_data):
+            names = set(field.name for field in self._get_fields())
+            d = dict((key, value) for key, value in dict_data.items() if key not in names)
             raise ValueError('contain unknown field: %s' % str(d))
 
+    def get_field_struct(self, field):
+        '''获取域的结构对象，供序列化器不经过reduce直接序列化，与reduce一样处理默认值和必填检查
+
+        :returns: 结构对象，不需要序列化时返回None
+        '''
+        value = self.__ddict.get(field.name, None)
+        if isinstance(value, LazyValue):
+            value = self._load_lazy_field(field, value)
+        if value is None:
+            if field.required:
+                if field.has_default:
+                    obj = field.type.create(field.params)
+                    obj.from_assignment(field.default, field)
+                    return obj
+                elif issubclass(field.type, ArrayBase):
+                    return field.type.create(field.params)
+                else:
+                    raise ValueError('required field "%s" of "%s" is not set' % (field.name, type(self.get_message()).__name__))
+            return None
+        if isinstance(value, StructTypeBase) and not value.need_reduce():
+            return None
+        return value
+
+    def _load_lazy_field(self, field, lazy_value):
+        '''解码延迟解码的域
+        '''
+        obj = field.type.create(field.params)
+        obj.construct(lazy_value.load(), field)
+        self.__ddict[field.name] = obj
+        return obj
+
     def reduce(self, allow_uninit_field=False):
         '''退化为Python基本类型
         '''
         d = OrderedDictEx()
         for field in self._get_fields():
             value = self.__ddict.get(field.name, None)
+            if isinstance(value, LazyValue):
+                value = self._load_lazy_field(field, value)
             if value is None:
                 if field.required:
                     if field.has_default:
@@ -1172,50 +1422,62 @@ class Dict(CompositeType):
         if name[0:7] == '_Dict__' or name[0:17] == '_StructTypeBase__':
             super(Dict, self).__setattr__(name, value)
         else:
-            for field in self._get_fields():
-                if field.name == name or field.display == name:
-                    if value == Uninitialized:
-                        return
-                    if value is None and field.allow_none:
-                        self.__ddict[field.name] = Null()
-                    else:
-                        if issubclass(field.type, StructTypeBase):
-                            obj = field.type.create(field.params)
-                            obj.from_assignment(value, field)
-                        else:
-                            obj = value
-                        self.__ddict[field.name] = obj
-                    return
-            raise TypeError('assign unknown field: %s' % name)
+            field = type(self).get_field_index().get(name)
+            if field is None:
+                raise TypeError('assign unknown field: %s' % name)
+            self._set_field_value(field, value)
+
+    def _set_field_value(self, field, value):
+        '''设置域的值
+        '''
+        if value == Uninitialized:
+            return
+        if value is None and field.allow_none:
+            self.__ddict[field.name] = Null()
+        else:
+            if issubclass(field.type, StructTypeBase):
+                obj = field.type.create(field.params)
+                obj.from_assignment(value, field)
+            else:
+                obj = value
+            self.__ddict[field.name] = obj
 
     def __getattribute__(self, name):
         '''查询成员属性
         '''
-        try:
-            return super(Dict, self).__getattribute__(name)
-        except AttributeError:
-            for field in self._get_fields():
-                if field.name == name or field.display == name:
-                    obj = self.__ddict.get(field.name, None)
-                    if obj is None:
-                        if issubclass(field.type, StructTypeBase):
-                            if issubclass(field.type, CompositeType):
-                                obj = field.type.create(field.params)
-                                self.__ddict[field.name] = obj
-                            elif field.has_default:
-                                obj = field.type.create(field.params)
-                                obj.from_assignment(field.default, field)
-                            else:
-                                raise AttributeError("access uninitialized field '%s' of '%s'" % (field.name, type(self.get_message()).__name__))
-                        else:
-                            obj = field.type()
-                            self.__ddict[field.name] = obj
-                    if isinstance(obj, StructTypeBase):
-                        return obj.to_use()
-                    else:
-                        return obj
+        field = type(self)._get_field_table()[3].get(name)
+        if field is None:
+            try:
+                return super(Dict, self).__getattribute__(name)
+            except AttributeError:
+                field = type(self).get_field_index().get(name)
+                if field is None:
+                    raise AttributeError('query unknown field: %s' % name)
+        return self._get_field_value(field)
+
+    def _get_field_value(self, field):
+        '''查询域的值
+        '''
+        obj = self.__ddict.get(field.name, None)
+        if isinstance(obj, LazyValue):
+            obj = self._load_lazy_field(field, obj)
+        if obj is None:
+            if issubclass(field.type, StructTypeBase):
+                if issubclass(field.type, CompositeType):
+                    obj = field.type.create(field.params)
+                    self.__ddict[field.name] = obj
+                elif field.has_default:
+                    obj = field.type.create(field.params)
+                    obj.from_assignment(field.default, field)
+                else:
+                    raise AttributeError("access uninitialized field '%s' of '%s'" % (field.name, type(self.get_message()).__name__))
             else:
-                raise AttributeError('query unknown field: %s' % name)
+                obj = field.type()
+                self.__ddict[field.name] = obj
+        if isinstance(obj, StructTypeBase):
+            return obj.to_use()
+        else:
+            return obj
 
     def __eq__(self, obj):
         if type(self) != type(obj):
@@ -1509,10 +1771,27 @@ class Variant(CompositeType):
             return msg
 
 
+class _FieldAccessor(object):
+    '''消息类型上对应一个域的描述符，直接读写消息结构中的域
+    '''
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, msg, owner):
+        if msg is None:
+            return self
+        return msg._Message__struct._get_field_value(self.field)
+
+    def __set__(self, msg, value):
+        msg._Message__struct._set_field_value(self.field, value)
+
+
 class Message(object):
     '''消息定义接口
     '''
     _serializer_ = None
+    _message_fields_ = {}  # 可以直接读写的域，由get_struct_class生成
 
     def __init__(self, *args, **kwargs):
         '''构造函数
@@ -1561,6 +1840,7 @@ class Message(object):
             struct_class = type(cls.__name__ + '_Dict', tuple(base_classes), {'_fields_': struct,
                                                                 '__module__' : cls.__module__})
             cls._struct_ = struct_class
+            cls._install_field_accessors(struct_class)
         else:
             # 不带域的类型，比如String、Array
             struct_class = struct
@@ -1569,6 +1849,24 @@ class Message(object):
         struct_class.set_message_class(cls)
         return struct_class
 
+    @classmethod
+    def _install_field_accessors(cls, struct_class):
+        '''为各个域生成描述符，与消息类型或结构类型的属性同名的域除外
+        '''
+        message_fields = {}
+        for name, field in struct_class._get_field_table()[3].items():
+            for klass in cls.__mro__:
+                if name in klass.__dict__:
+                    if isinstance(klass.__dict__[name], _FieldAccessor):
+                        break
+                    else:
+                        field = None
+                        break
+            if field is not None:
+                setattr(cls, name, _FieldAccessor(field))
+                message_fields[name] = field
+        cls._message_fields_ = message_fields
+
     def get_struct(self):
         '''获取结构
         '''
@@ -1577,27 +1875,25 @@ class Message(object):
     def __setattr__(self, name, value):
         '''设置成员属性
         '''
-        if fnmatch.fnmatch(name, "_*__*"):
+        field = type(self)._message_fields_.get(name)
+        if field is not None:
+            self.__struct._set_field_value(field, value)
+        elif name[:1] == '_' and name.find('__', 1) > 0:
             super(Message, self).__setattr__(name, value)
+        elif name == 'value' and not isinstance(self.__struct, CompositeType):
+            self.__struct.from_assignment(value)
         else:
-            if name == 'value' and not isinstance(self.__struct, CompositeType):
-                self.__struct.from_assignment(value)
-            else:
-                setattr(self.__struct, name, value)
+            setattr(self.__struct, name, value)
 
-    def __getattribute__(self, name):
-        '''查询成员属性
+    def __getattr__(self, name):
+        '''查询成员属性，实例和类型都没有该属性时才调用
         '''
-        try:
-            return super(Message, self).__getattribute__(name)
-        except AttributeError:
-            if name == 'value' and not isinstance(self.__struct, CompositeType):
-                return self.__struct.to_use()
-            else:
-                if fnmatch.fnmatch(name, "_*__struct"):
-                    return {}
-                else:
-                    return getattr(self.__struct, name)
+        if name[:1] == '_' and len(name) > 8 and name.endswith('__struct'):
+            return {}
+        if name == 'value' and not isinstance(self.__struct, CompositeType):
+            return self.__struct.to_use()
+        else:
+            return getattr(self.__struct, name)
 
     def __repr__(self):
         return repr(self.__struct)
@@ -1685,16 +1981,13 @@ class Message(object):
         '''
         from qt4s.message.serializers.python import PythonSerializer
         serializer = serializer or self._serializer_ or PythonSerializer()
-        struct_class = self.get_struct_class()
-        if serializer.field_size_of_support is False:
-            data = self.__struct.reduce()
-            return serializer.dumps(struct_class, data)
-        else:
+        if serializer.field_size_of_support is not False:
             self.fill_size_ref(serializer)
             self.set_message_length(serializer)
-            data = self.__struct.reduce()
-            buf = serializer.dumps(struct_class, data)
-            return buf
+        dumps_struct = getattr(serializer, 'dumps_struct', None)
+        if dumps_struct is None:  # 未继承SerializerItf的序列化器
+            return serializer.dumps(self.get_struct_class(), self.__struct.reduce())
+        return dumps_struct(self.__struct)
 
     def loads(self, value, deserializer=None):
         '''反序列化
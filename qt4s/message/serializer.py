@@ -9,6 +9,88 @@ import json
 import urllib
 
 
+class BufferWriter(object):
+    '''基于bytearray的缓冲区写操作，支持预分配、预留位置回填和零拷贝获取
+    '''
+
+    def __init__(self, size_hint=256):
+        self._buf = bytearray(size_hint)
+        self._pos = 0
+
+    def _ensure(self, size):
+        '''保证当前偏移量之后至少有size字节可写
+        '''
+        capacity = len(self._buf)
+        end = self._pos + size
+        if end > capacity:
+            self._buf.extend(bytearray(max(capacity, end - capacity)))
+
+    def write_data(self, data):
+        '''写入数据，unicode按ASCII编码写入，与拼接为字符串时的隐式转换一致
+        '''
+        if isinstance(data, unicode):
+            try:
+                data = data.encode('ascii')
+            except UnicodeEncodeError:
+                raise ValueError('unicode data %r could not be written as bytes, use an encoding other than "unicode"' % data)
+        end = self._pos + len(data)
+        if end > len(self._buf):
+            self._ensure(len(data))
+        self._buf[self._pos:end] = data
+        self._pos = end
+
+    def write_struct(self, st, *values):
+        '''使用预编译的Struct写入数据
+        '''
+        if self._pos + st.size > len(self._buf):
+            self._ensure(st.size)
+        st.pack_into(self._buf, self._pos, *values)
+        self._pos += st.size
+
+    def reserve(self, size):
+        '''预留size字节，返回预留位置的偏移量，之后使用pack_into回填
+        '''
+        self._ensure(size)
+        pos = self._pos
+        self._pos += size
+        return pos
+
+    def pack_into(self, st, offset, *values):
+        '''在指定偏移量回填数据
+        '''
+        if offset + st.size > self._pos:
+            raise ValueError("pack to offset=%s out of written range %s" % (offset, self._pos))
+        st.pack_into(self._buf, offset, *values)
+
+    def detach(self):
+        '''获取字符串
+        '''
+        data = memoryview(self._buf)[:self._pos].tobytes()
+        self._buf = None
+        return data
+
+    def detach_view(self):
+        '''获取已写入数据的memoryview，不拷贝数据
+        '''
+        view = memoryview(self._buf)[:self._pos]
+        self._buf = None
+        return view
+
+    def get_pos(self):
+        '''获取当前偏移量
+        '''
+        return self._pos
+
+    def get_buffer(self, begin=None, end=None):
+        '''获取缓存区字符串
+        '''
+        if begin is None:
+            begin = 0
+        if end is None:
+            end = self._pos
+        return memoryview(self._buf)[begin:end].tobytes()
+
+
 class SerializerItf(object):
     '''序列化器接口
     '''
@@ -23,6 +105,15 @@ class SerializerItf(object):
         '''
         raise NotImplementedError
 
+    def dumps_struct(self, struct):
+        '''直接从结构对象序列化，默认先退化为Python基本类型再序列化
+        :param struct: 需要序列化的结构对象
+        :type struct: qt4s.message.definition.StructTypeBase
+        :returns: 序列化结果
+        :rtype: 根据不同的序列化器而不同
+        '''
+        return self.dumps(type(struct), struct.reduce())
+
     def loads(self, struct_class, value):
         '''反序列化
         :param value: 序列化结果
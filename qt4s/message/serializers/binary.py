@@ -34,10 +34,12 @@ assert test2.B2.get_buffer() == "XXXXXXXX"
 assert test2.Len == 0x12345678
 '''
 
+import array
 import struct
+import sys
 import traceback
 
-from qt4s.message.serializer import SerializerItf
+from qt4s.message.serializer import SerializerItf, BufferWriter
 from qt4s.message.definition import *
 
 
@@ -62,42 +64,6 @@ class BinaryEndian(object):
     Network = '!'
 
 
-class BufferWriter(object):
-    '''数据缓冲区写操作
-    '''
-
-    def __init__(self):
-        self._buf = ''
-        self._pos = 0
-
-    def write_data(self, data):
-        '''写入数据
-        '''
-        self._buf += data
-        self._pos += len(data)
-
-    def detach(self):
-        '''获取字符串
-        '''
-        buf = self._buf
-        self._buf = None
-        return buf
-
-    def get_pos(self):
-        '''获取当前偏移量
-        '''
-        return self._pos
-
-    def get_buffer(self, begin=None, end=None):
-        '''获取缓存区字符串
-        '''
-        if begin is None:
-            begin = 0
-        if end is None:
-            end = len(self._buf)
-        return self._buf[begin:end]
-
-
 class BufferReader(object):
     '''缓冲区读操作
     '''
@@ -118,6 +84,18 @@ class BufferReader(object):
         self._pos += size
         return data
 
+    def get_remain_size(self):
+        '''获取剩余未读的长度
+        '''
+        return len(self._buf) - self._pos
+
+    def read_struct(self, st):
+        '''使用预编译的Struct读数据
+        '''
+        data = st.unpack_from(self._buf, self._pos)
+        self._pos += st.size
+        return data
+
     def read_raw_data(self, size=None):
         '''读数据
         '''
@@ -147,6 +125,7 @@ class BufferReader(object):
 class BinaryDecodeTracer(object):
     '''记录解码过程
     '''
+    enabled = True
 
     def __init__(self):
         self._depth = 0
@@ -177,6 +156,27 @@ class BinaryDecodeTracer(object):
         return '\n'.join(self._logs)
 
 
+class _NullDecodeTracer(object):
+    '''不记录解码过程，用于快速解码
+    '''
+    enabled = False
+
+    def inc_depth(self):
+        pass
+
+    def dec_depth(self):
+        pass
+
+    def log(self, struct_type, data, value, field_info):
+        pass
+
+    def get_traceback(self):
+        return ''
+
+
+_null_tracer = _NullDecodeTracer()
+
+
 TYPE_FLAG_MAP = {
     Float:'f',
     Double:'d',
@@ -191,15 +191,153 @@ TYPE_FLAG_MAP = {
     Int8:'b',
 }
 
+# 编码格式 => 内存布局相同的array.array类型码
+_ARRAY_TYPECODES = dict((flag, typecode) for flag, typecode in [('b', 'b'), ('B', 'B'), ('h', 'h'), ('H', 'H'),
+                                                                 ('i', 'i'), ('I', 'I'), ('q', 'l'), ('Q', 'L'),
+                                                                 ('f', 'f'), ('d', 'd')]
+                        if array.array(typecode).itemsize == struct.calcsize('=' + flag))
+
+# 与本机字节序一致，array.array不需要交换字节序的编码方式
+_NATIVE_ENDIANS = (BinaryEndian.Native, BinaryEndian.LittleEndian if sys.byteorder == 'little' else BinaryEndian.BigEndian)
+
+
+def _reduce(value):
+    '''结构对象退化为Python基本类型
+    '''
+    if isinstance(value, StructTypeBase):
+        return value.reduce()
+    return value
+
+
+class _FixedFieldsStep(object):
+    '''连续的定长数值域，使用一个预编译的Struct编解码
+    '''
+
+    def __init__(self, endian, fields):
+        self.fields = fields
+        self.names = tuple(it.name for it in fields)
+        self.struct = struct.Struct(endian + ''.join(TYPE_FLAG_MAP[it.type] for it in fields))
+        self.offsets = []
+        offset = 0
+        for it in fields:
+            size = struct.calcsize(endian + TYPE_FLAG_MAP[it.type])
+            self.offsets.append((offset, offset + size))
+            offset += size
+
+
+class DictCodecPlan(object):
+    '''字典结构的编解码计划，由域列表编译得到，按类和字节序缓存
+    '''
+
+    def __init__(self, struct_class, endian):
+        self.steps = []
+        fixed_fields = []
+        for it in struct_class.get_fields():
+            if it.required and it.type in TYPE_FLAG_MAP and it.type is not Bool \
+                and "serializer" not in it.params:
+                fixed_fields.append(it)
+                continue
+            if fixed_fields:
+                self.steps.append(_FixedFieldsStep(endian, fixed_fields))
+                fixed_fields = []
+            self.steps.append(it)
+        if fixed_fields:
+            self.steps.append(_FixedFieldsStep(endian, fixed_fields))
+
+    @classmethod
+    def get(cls, struct_class, endian):
+        '''获取结构类型的编解码计划，只编译一次
+        '''
+        plans = struct_class.__dict__.get('_binary_codec_plans_')
+        if plans is None:
+            plans = {}
+            setattr(struct_class, '_binary_codec_plans_', plans)
+        plan = plans.get(endian)
+        if plan is None:
+            plan = plans[endian] = cls(struct_class, endian)
+        return plan
+
+
+class BinaryLayout(object):
+    '''结构类型的静态布局，记录定长前缀中各个域的偏移量和长度，按类缓存
+    '''
+
+    def __init__(self, struct_class):
+        self.fields = struct_class.get_fields()
+        self.field_map = {}
+        self.sizes = []
+        self.offsets = []
+        self.prefix_count = None  # 第一个变长域的序号
+        offset = 0
+        for index, it in enumerate(self.fields):
+            self.field_map[it.name] = index
+            size = self.static_size_of(it)
+            self.sizes.append(size)
+            self.offsets.append(offset)
+            if offset is not None and size is None:
+                self.prefix_count = index
+                offset = None
+            elif offset is not None:
+                offset += size
+        self.size = offset  # 结构总长度，变长结构为None
+        if self.prefix_count is None:
+            self.prefix_count = len(self.fields)
+            self.prefix_size = offset
+        else:
+            self.prefix_size = self.offsets[self.prefix_count]
+
+    @staticmethod
+    def static_size_of(field_info):
+        '''获取域的静态长度，长度与取值有关时返回None
+        '''
+        if "serializer" in field_info.params:
+            return None
+        field_type = field_info.type
+        if field_type in TYPE_FLAG_MAP and field_type is not Bool:
+            return struct.calcsize('!' + TYPE_FLAG_MAP[field_type])
+        if issubclass(field_type, String):
+            return field_info.params.get("byte_size") or None
+        if issubclass(field_type, Dict):
+            return BinaryLayout.get(field_type).size
+        return None
+
+    @classmethod
+    def get(cls, struct_class):
+        '''获取结构类型的布局，只计算一次
+        '''
+        layout = struct_class.__dict__.get('_binary_layout_')
+        if layout is None:
+            layout = cls(struct_class)
+            setattr(struct_class, '_binary_layout_', layout)
+        return layout
+
+    @classmethod
+    def of(cls, value):
+        '''获取消息对象的布局
+        '''
+        return cls.get(type(value.get_struct()))
+
+    def index_of(self, name):
+        try:
+            return self.field_map[name]
+        except KeyError:
+            raise ValueError('no field named "%s" found' % name)
+
 
 class BinarySerializer(SerializerItf):
     '''二进制编码序列化器
     '''
     field_size_of_support = True
 
-    def __init__(self, endian=BinaryEndian.Network):
+    def __init__(self, endian=BinaryEndian.Network, trace=False):
+        '''构造函数
+        :param endian: 字节序
+        :param trace: 是否总是记录解码过程，默认只在解码失败时重新解码以记录过程
+        '''
         self._endian = endian
+        self._trace = trace
         self._buf = None
+        self._tracer = _null_tracer
 
     def dumps(self, struct_class, value):
         '''序列化
@@ -208,6 +346,55 @@ class BinarySerializer(SerializerItf):
         self._dumps(struct_class, value)
         return self._buf.detach()
 
+    def dumps_struct(self, struct):
+        '''直接从结构对象序列化，不经过reduce
+        '''
+        self._buf = BufferWriter()
+        self._dump_struct(type(struct), struct)
+        return self._buf.detach()
+
+    def _dump_struct(self, struct_class, obj, config=None):
+        '''从结构对象序列化
+        '''
+        if config and "serializer" in config:
+            serializer = config["serializer"]
+            dumps_struct = getattr(serializer, "dumps_struct", None)
+            if isinstance(obj, StructTypeBase) and dumps_struct is not None:
+                data = dumps_struct(obj)
+            else:  # 值不是结构对象，或序列化器未继承SerializerItf
+                data = serializer.dumps(struct_class, _reduce(obj))
+            self._buf.write_data(data)
+        elif issubclass(struct_class, Dict):
+            for it in DictCodecPlan.get(struct_class, self._endian).steps:
+                if isinstance(it, _FixedFieldsStep):
+                    self._buf.write_struct(it.struct, *[_reduce(self._get_field_struct(obj, field))
+                                                        for field in it.fields])
+                    continue
+                field_obj = self._get_field_struct(obj, it)
+                if field_obj is not None:
+                    self._dump_struct(it.type, field_obj, it.params)
+        elif issubclass(struct_class, ArrayBase):
+            element_struct = struct_class.element_struct
+            if isinstance(obj, NumericArrayBase):
+                self._dump_numeric_array(TYPE_FLAG_MAP[element_struct], obj.get_values())
+            else:
+                for it in obj.get_element_structs():
+                    self._dump_struct(element_struct, it)
+        elif struct_class == String or struct_class == Buffer:
+            self._buf.write_data(_reduce(obj))
+        elif issubclass(struct_class, (Number, Bool)):
+            self._dump_basic_type(TYPE_FLAG_MAP[struct_class], _reduce(obj))
+        else:
+            raise BinaryEncodeError('unsupported structure "%s"' % struct_class.__name__)
+
+    def _get_field_struct(self, obj, field):
+        '''获取域的结构对象，必填域的结构对象不需要序列化时与reduce的结果一样抛出KeyError
+        '''
+        field_obj = obj.get_field_struct(field)
+        if field_obj is None and field.required:
+            raise KeyError(field.name)
+        return field_obj
+
     def _dumps(self, struct_class, value, config=None, parent_class=None, parent_value=None):
         '''序列化
         '''
@@ -263,13 +450,30 @@ class BinarySerializer(SerializerItf):
         '''序列化数组
         '''
 #         self._dump_size_ref(value, config, parent_class, parent_value)
+        if element_struct in TYPE_FLAG_MAP and element_struct is not Bool:
+            self._dump_numeric_array(TYPE_FLAG_MAP[element_struct], value)
+            return
         for it in value:
             self._dumps(element_struct, it)
 
+    def _dump_numeric_array(self, flag, values):
+        '''序列化数值数组，array.array的内存布局与编码格式一致时直接写入其缓冲区
+        '''
+        if isinstance(values, array.array) and values.typecode == _ARRAY_TYPECODES.get(flag):
+            if self._endian not in _NATIVE_ENDIANS:
+                values = values[:]
+                values.byteswap()
+            self._buf.write_data(values.tostring())
+        else:
+            self._buf.write_data(struct.pack('%s%d%s' % (self._endian, len(values), flag), *values))
+
     def _dump_dict(self, value, struct_class, config, parent_class, parent_value):
         '''序列化字典结构
         '''
-        for it in struct_class.get_fields():
+        for it in DictCodecPlan.get(struct_class, self._endian).steps:
+            if isinstance(it, _FixedFieldsStep):
+                self._buf.write_struct(it.struct, *[value[name] for name in it.names])
+                continue
             if not it.required:
                     try:
                         value[it.name]
@@ -280,18 +484,28 @@ class BinarySerializer(SerializerItf):
     def loads(self, struct_class, buf):
         '''反序列化
         '''
-        self._tracer = BinaryDecodeTracer()
+        if not self._trace:
+            try:
+                return self._loads_with_tracer(struct_class, buf, _null_tracer)
+            except:
+                pass  # decode again with tracing for a detailed error
         try:
-            self._buf = BufferReader(buf)
-            obj = self._loads(struct_class)
-            if self._buf.is_eof():
-                remain = None
-            else:
-                remain = self._buf.get_buffer(begin=self._buf.get_pos())
-            return obj, remain
+            return self._loads_with_tracer(struct_class, buf, BinaryDecodeTracer())
         except:
             stack = traceback.format_exc()
             raise BinaryDecodeError("Error: %s\nFollowing is decoding trace:\n%s" % (stack, self._tracer.get_traceback()))
+        finally:
+            self._tracer = _null_tracer
+
+    def _loads_with_tracer(self, struct_class, buf, tracer):
+        self._tracer = tracer
+        self._buf = BufferReader(buf)
+        obj = self._loads(struct_class)
+        if self._buf.is_eof():
+            remain = None
+        else:
+            remain = self._buf.get_buffer(begin=self._buf.get_pos())
+        return obj, remain
 
     def _loads(self, struct_class, config=None, parent_class=None, parent_value=None, field_info=None):
         '''反序列化
@@ -329,11 +543,25 @@ class BinarySerializer(SerializerItf):
         '''反序列化基本类型
         '''
         size = struct.calcsize(flag)
+        if not self._tracer.enabled:
+            return self._buf.read_data(self._endian + flag, size)
         data = self._buf.get_buffer(self._buf.get_pos(), self._buf.get_pos() + size)
         value = self._buf.read_data(self._endian + flag, size)
         self._tracer.log(struct_class, data, value, field_info)
         return value
 
+    def _load_fixed_fields(self, step, mapdata):
+        '''反序列化连续的定长数值域
+        '''
+        pos = self._buf.get_pos()
+        values = self._buf.read_struct(step.struct)
+        if not self._tracer.enabled:
+            mapdata.update(zip(step.names, values))
+            return
+        for field, (begin, end), value in zip(step.fields, step.offsets, values):
+            self._tracer.log(field.type, self._buf.get_buffer(pos + begin, pos + end), value, field.name)
+            mapdata[field.name] = value
+
     def _load_string(self, config, parent_class, parent_value, field_info):
         '''序列化字符串
         '''
@@ -369,6 +597,16 @@ class BinarySerializer(SerializerItf):
         array_size = config.get('array_size', None)
         if size_ref is None and array_size is None:
             raise BinaryDecodeError('array type require "size_ref" or "array_size" option')
+        if element_class in TYPE_FLAG_MAP and element_class is not Bool:
+            if size_ref:
+                size = parent_value.get(size_ref, None)
+                if size is None:
+                    raise BinaryDecodeError('array type field decoding require "%s" field' % size_ref)
+            else:
+                size = array_size or None
+            arrdata = self._load_numeric_array(element_class, size)
+            self._tracer.dec_depth()
+            return arrdata
         if size_ref:
             size = parent_value.get(size_ref, None)
             if size is None:
@@ -394,13 +632,34 @@ class BinarySerializer(SerializerItf):
                 self._tracer.dec_depth()
                 return arrdata
 
+    def _load_numeric_array(self, element_class, size):
+        '''使用一次unpack_from反序列化数值数组，size为None时读取到缓冲区末尾
+        '''
+        flag = TYPE_FLAG_MAP[element_class]
+        element_size = struct.calcsize(self._endian + flag)
+        if size is None:
+            size, remain = divmod(self._buf.get_remain_size(), element_size)
+            if remain:
+                raise BinaryDecodeError('%s bytes remained could not be decoded as %s array' % (
+                    self._buf.get_remain_size(), element_class.__name__))
+        pos = self._buf.get_pos()
+        arrdata = list(self._buf.read_struct(struct.Struct('%s%d%s' % (self._endian, size, flag))))
+        if self._tracer.enabled:
+            for i, value in enumerate(arrdata):
+                begin = pos + i * element_size
+                self._tracer.log(element_class, self._buf.get_buffer(begin, begin + element_size), value, i)
+        return arrdata
+
     def _load_dict(self, struct_class, field_info):
         '''序列化字典
         '''
         self._tracer.log(struct_class, None, None, field_info)
         self._tracer.inc_depth()
         mapdata = {}
-        for it in struct_class.get_fields():
+        for it in DictCodecPlan.get(struct_class, self._endian).steps:
+            if isinstance(it, _FixedFieldsStep):
+                self._load_fixed_fields(it, mapdata)
+                continue
             if self._buf.is_eof() and not it.required:
                 continue
             mapdata[it.name] = self._loads(it.type, it.params, struct_class, mapdata, it.name)
@@ -410,7 +669,11 @@ class BinarySerializer(SerializerItf):
     def size_of(self, value):
         total_size = 0
         if isinstance(value, Message):
-            for field_info in value.get_fields():
+            layout = BinaryLayout.of(value)
+            if layout.size is not None:
+                return layout.size
+            total_size = layout.prefix_size
+            for field_info in layout.fields[layout.prefix_count:]:
                 total_size += self.field_size_of(value, field_info.name)
         else:
             if isinstance(value, type):
@@ -426,33 +689,44 @@ class BinarySerializer(SerializerItf):
                 raise ValueError('unsupported value=%r' % value)
         return total_size
 
-    def get_field_info(self, value, field_name):
+    def _locate_field(self, value, field_name):
+        '''查找域，返回域所在结构的布局、域的序号、域的值和上层结构对象
+        '''
         if not isinstance(value, Message):
             raise TypeError("value=%r does not match Message type" % value)
 
-        field_parts = field_name.split(".")
-        found_parts = []
         field_value = value
-        field_info = None
         parent_value = None
-        for field_part in field_parts:
-            for temp_info in field_value.get_fields():
-                if temp_info.name == field_part:
-                    field_info = temp_info
-                    if issubclass(temp_info.type, Number):  # incase uninitialized
-                        field_value = None
-                    else:
-                        parent_value = field_value
-                        field_value = getattr(field_value, field_part)
-                    found_parts.append(field_part)
-                    break
-        if found_parts != field_parts:
-            raise ValueError("%r has no field named: %s" % (value, field_name))
-        return field_info, field_value, parent_value
+        layout = index = None
+        for field_part in field_name.split("."):
+            if not isinstance(field_value, Message):
+                raise ValueError("%r has no field named: %s" % (value, field_name))
+            layout = BinaryLayout.of(field_value)
+            index = layout.field_map.get(field_part)
+            if index is None:
+                raise ValueError("%r has no field named: %s" % (value, field_name))
+            if issubclass(layout.fields[index].type, Number):  # incase uninitialized
+                field_value = None
+            else:
+                parent_value = field_value
+                field_value = getattr(field_value, field_part)
+        return layout, index, field_value, parent_value
+
+    def get_field_info(self, value, field_name):
+        layout, index, field_value, parent_value = self._locate_field(value, field_name)
+        return layout.fields[index], field_value, parent_value
 
     def field_size_of(self, value, field_name):
+        layout, index, field_value, _ = self._locate_field(value, field_name)
+        return self._field_size_of(field_value, layout, index)
+
+    def _field_size_of(self, field_value, layout, index):
+        '''计算域的长度，field_value为域的值
+        '''
+        if layout.sizes[index] is not None:
+            return layout.sizes[index]
         field_size = 0
-        field_info, field_value, _ = self.get_field_info(value, field_name)
+        field_info = layout.fields[index]
         if "serializer" in field_info.params:
             field_serializer = field_info.params["serializer"]
         else:
@@ -481,15 +755,16 @@ class BinarySerializer(SerializerItf):
         field_parts = field_name.split(".")
         field_value = value
         total_offset = 0
-        for field_part in field_parts[:-1]:
-            total_offset += self.offset_of(field_value, field_part)
-            field_value = getattr(field_value, field_part)
-        for field_info in field_value.get_fields():
-            if field_info.name == field_parts[-1]:
-                break
+        for i, field_part in enumerate(field_parts):
+            layout = BinaryLayout.of(field_value)
+            index = layout.index_of(field_part)
+            if index <= layout.prefix_count:
+                total_offset += layout.offsets[index]
             else:
-                total_offset += self.field_size_of(field_value, field_info.name)
-        else:
-            raise ValueError('no field named "%s" found' % field_name)
+                total_offset += layout.prefix_size
+                for field_info in layout.fields[layout.prefix_count:index]:
+                    total_offset += self.field_size_of(field_value, field_info.name)
+            if i < len(field_parts) - 1:
+                field_value = getattr(field_value, field_part)
         return total_offset
 
@@ -2,10 +2,16 @@
 '''JCE序列化器
 '''
 
-from qt4s.message.serializer import SerializerItf
+from qt4s.message.serializer import SerializerItf, BufferWriter as _BufferWriter
 from qt4s.message.definition import *
+import copy
+import importlib
+import pkgutil
 import struct
 
+_HEAD_STRUCT = struct.Struct('!B')
+_LONG_HEAD_STRUCT = struct.Struct('!H')
+
 
 class JceEncodeError(Exception):
     '''编码时出错
@@ -54,6 +60,16 @@ class DataHeadType:
     BYTES = 13
 
 
+_FIXED_SIZES = {
+    DataHeadType.INT8: 1,
+    DataHeadType.INT16: 2,
+    DataHeadType.INT32: 4,
+    DataHeadType.INT64: 8,
+    DataHeadType.FLOAT: 4,
+    DataHeadType.DOUBLE: 8,
+    DataHeadType.ZERO: 0,
+}
+
 _headType_StructTypeMap = {
     0: Uint8,
     1: Uint16,
@@ -68,73 +84,38 @@ _headType_StructTypeMap = {
 }
 
 
-class BufferWriter(object):
+class BufferWriter(_BufferWriter):
     '''数据缓冲区写操作
     '''
 
-    def __init__(self):
-        self._buf = ''
-        self._pos = 0
-
     def write_head(self, vtype, tag):
         '''写入一个信息头
         '''
         if tag < 15 :
-            head = (tag << 4) | vtype;
-            data = struct.pack('!B', head)
+            self.write_struct(_HEAD_STRUCT, (tag << 4) | vtype)
         else:
-            head = ((0xF0 | vtype) << 8) | tag;
-            data = struct.pack('!H', head)
-        self._buf += data
-        self._pos += len(data)
-
-    def write_data(self, data):
-        '''写入数据
-        '''
-        self._buf += data
-        self._pos += len(data)
-
-    def detach(self):
-        '''获取字符串
-        '''
-        buf = self._buf
-        self._buf = None
-        return buf
-
-    def get_pos(self):
-        '''获取当前偏移量
-        '''
-        return self._pos
-
-    def get_buffer(self, begin=None, end=None):
-        '''获取缓存区字符串
-        '''
-        if begin is None:
-            begin = 0
-        if end is None:
-            end = self._pos
-        return self._buf[begin:end]
+            self.write_struct(_LONG_HEAD_STRUCT, ((0xF0 | vtype) << 8) | tag)
 
 
 class BufferReader(object):
     '''缓冲区读操作
     '''
 
-    def __init__(self, buf):
+    def __init__(self, buf, pos=0):
         self._buf = buf
-        self._pos = 0
+        self._pos = pos
 
     def read_head(self):
         '''读一个信息头
         '''
         # print 'read head, pos=', self._pos
-        head = struct.unpack_from('!B', self._buf, self._pos)[0]
+        head = _HEAD_STRUCT.unpack_from(self._buf, self._pos)[0]
         tag = (head & 0xF0) >> 4
         vtype = (head & 0x0F)
         posinc = 1
         if tag >= 15:
             posinc = 2
-            tag = struct.unpack_from('!B', self._buf, self._pos + 1)[0]
+            tag = _HEAD_STRUCT.unpack_from(self._buf, self._pos + 1)[0]
         self._pos += posinc
         return vtype, tag
 
@@ -150,6 +131,13 @@ class BufferReader(object):
         self._pos += size
         return buf
 
+    def skip(self, size):
+        '''跳过数据
+        '''
+        if self._pos + size > len(self._buf):
+            raise JceDecodeError('skip %d bytes out of buffer at %d' % (size, self._pos))
+        self._pos += size
+
     def get_buffer(self, begin=None, end=None):
         '''获取缓存区字符串
         '''
@@ -164,14 +152,30 @@ class BufferReader(object):
         '''
         return self._pos
 
+    def get_data(self):
+        '''获取原始数据
+        '''
+        return self._buf
+
 
 class JceSerializer(SerializerItf):
     '''JCE序列化
     '''
 
-    def __init__(self, ignore_unknown_tag=True):
+    def __init__(self, ignore_unknown_tag=True, unknown_tag_handler=None, lazy=False, use_codec=True):
+        '''构造函数
+
+        :param ignore_unknown_tag: 是否跳过未定义的tag，否则解码时抛出JceDecodeError
+        :param unknown_tag_handler: 跳过未定义的tag时的回调，参数为(struct_class, tag, vtype)
+        :param lazy: 是否延迟解码结构体、映射表和数组类型的域，只记录数据位置，首次访问时才解码
+        :param use_codec: 是否使用生成的编解码函数，参考qt4s.message.serializers.jce_codec
+        '''
         self._buf = None
         self._ignore_unknown_field = ignore_unknown_tag
+        self._unknown_tag_handler = unknown_tag_handler
+        self._lazy = lazy
+        self._use_codec = use_codec
+        self.unknown_tag_count = 0
 
     def dumps(self, struct_class, value):
         '''序列化
@@ -186,40 +190,10 @@ class JceSerializer(SerializerItf):
     def _dumps(self, struct_class, tag, value):
         '''序列化
         '''
-        if issubclass(struct_class, Dict):
-            self._dump_dict(tag, value, struct_class)
-        elif issubclass(struct_class, MapBase):
-            self._dump_map(tag, value, struct_class.key_struct, struct_class.value_struct)
-        elif issubclass(struct_class, ArrayBase):
-            self._dump_array(tag, value, struct_class.element_struct)
-        elif struct_class == String:
-            self._dump_string(tag, value)
-        elif struct_class == Buffer:
-            self._dump_buffer(tag, value)
-        elif struct_class == Float:
-            self._dump_float(tag, value)
-        elif struct_class == Double:
-            self._dump_double(tag, value)
-        elif struct_class == Bool:
-            self._dump_bool(tag, value)
-        elif struct_class == Uint64:
-            self._dump_int64(tag, value, True)
-        elif struct_class == Int64:
-            self._dump_int64(tag, value, False)
-        elif struct_class == Uint32:
-            self._dump_int32(tag, value, True)
-        elif struct_class == Int32:
-            self._dump_int32(tag, value, False)
-        elif struct_class == Uint16:
-            self._dump_int16(tag, value, True)
-        elif struct_class == Int16:
-            self._dump_int16(tag, value, False)
-        elif struct_class == Uint8:
-            self._dump_int8(tag, value, True)
-        elif struct_class == Int8:
-            self._dump_int8(tag, value, False)
-        else:
+        dumper = _find_codec(_DUMPERS, struct_class, self._get_codec_cache('_jce_dumper_cache_'))
+        if dumper is None:
             raise JceEncodeError('unsupported structure "%s"' % struct_class.__name__)
+        dumper(self, tag, value, struct_class)
 
     def _dump_int64(self, tag, value, unsigned):
         '''序列化64数值
@@ -321,13 +295,17 @@ class JceSerializer(SerializerItf):
     def _internal_dump_dict(self, value, struct_class):
         '''序列化字典结构
         '''
-        for it in struct_class.get_fields():
-            if not it.required:
+        table = _JceFieldTable.get(struct_class)
+        if table.encoder is not None and self._use_codec:
+            table.encoder(self, value, table.types)
+            return
+        for name, required, tag, field_type, dumper in table.items:
+            if not required:
                 try:
-                    value[it.name]
+                    value[name]
                 except KeyError:
                     continue
-            self._dumps(it.type, it.params['tag'], value[it.name])
+            dumper(self, tag, value[name], field_type)
 
     def _dump_map(self, tag, mapdata, kstruct, vstruct):
         '''序列化映射表
@@ -342,30 +320,32 @@ class JceSerializer(SerializerItf):
     def _get_field(self, struct_class, tag):
         '''通过tag找到对应的域
         '''
-        for field in struct_class.get_fields():
-            if field.params['tag'] == tag:
-                return field
-        else:
-            if not self._ignore_unknown_field:
-                raise JceDecodeError('invalid tag value %d for structure "%s"' % (tag, struct_class.__name__))
+        entry = _JceFieldTable.get(struct_class).tags.get(tag)
+        if entry is not None:
+            return entry[0]
+        if not self._ignore_unknown_field:
+            raise JceDecodeError('invalid tag value %d for structure "%s"' % (tag, struct_class.__name__))
 
     def loads(self, struct_class, buf):
         '''反序列化
         '''
-        dictdata = {}
+        table = _JceFieldTable.get(struct_class)
         self._buf = BufferReader(buf)
+        if table.decoder is not None and self._use_codec:
+            return table.decoder(self, struct_class, table.types, False), None
+        dictdata = {}
+        tags = table.tags
         while not self._buf.is_eof():
             vtype, tag = self._buf.read_head()
-            field = self._get_field(struct_class, tag)
-            if field is not None:
-                dictdata[field.name] = self._loads(field.type, vtype)
-            else:
-                value = self._loads_unknown(vtype)
-                err_msg = "no field match tag=%r value=%s for struct class %r" % (tag, value, struct_class)
-                if self._ignore_unknown_field:
-                    print(err_msg)
+            entry = tags.get(tag)
+            if entry is not None:
+                field, loader, composite = entry
+                if composite and self._lazy:
+                    dictdata[field.name] = self._load_lazy(vtype, field.type)
                 else:
-                    raise JceDecodeError(err_msg)
+                    dictdata[field.name] = loader(self, vtype, field.type)
+            else:
+                self._skip_unknown(struct_class, tag, vtype)
         return dictdata, None
 
     def loads_unknown(self, buf):
@@ -379,40 +359,20 @@ class JceSerializer(SerializerItf):
     def _loads(self, struct_class, vtype):
         '''反序列化
         '''
-        if issubclass(struct_class, Dict):
-            return self._load_dict(vtype, struct_class)
-        elif issubclass(struct_class, MapBase):
-            return self._load_map(vtype, struct_class, struct_class.key_struct, struct_class.value_struct)
-        elif issubclass(struct_class, ArrayBase):
-            return self._load_array(vtype, struct_class, struct_class.element_struct)
-        elif struct_class == String:
-            return self._load_string(vtype, struct_class)
-        elif struct_class == Buffer:
-            return self._load_buffer(vtype, struct_class)
-        elif struct_class == Float:
-            return self._load_float(vtype, struct_class)
-        elif struct_class == Double:
-            return self._load_double(vtype, struct_class)
-        elif struct_class == Bool:
-            return self._load_bool(vtype, struct_class)
-        elif struct_class == Uint64:
-            return self._load_int64(vtype, struct_class, True)
-        elif struct_class == Int64:
-            return self._load_int64(vtype, struct_class, False)
-        elif struct_class == Uint32:
-            return self._load_int32(vtype, struct_class, True)
-        elif struct_class == Int32:
-            return self._load_int32(vtype, struct_class, False)
-        elif struct_class == Uint16:
-            return self._load_int16(vtype, struct_class, True)
-        elif struct_class == Int16:
-            return self._load_int16(vtype, struct_class, False)
-        elif struct_class == Uint8:
-            return self._load_int8(vtype, struct_class, True)
-        elif struct_class == Int8:
-            return self._load_int8(vtype, struct_class, False)
-        else:
+        loader = _find_codec(_LOADERS, struct_class, self._get_codec_cache('_jce_loader_cache_'))
+        if loader is None:
             raise JceDecodeError('unsupported structure "%s"' % struct_class.__name__)
+        return loader(self, vtype, struct_class)
+
+    @classmethod
+    def _get_codec_cache(cls, name):
+        '''获取序列化器类的编解码函数缓存，子类各自独立
+        '''
+        cache = cls.__dict__.get(name)
+        if cache is None:
+            cache = {}
+            setattr(cls, name, cache)
+        return cache
 
     def _loads_unknown(self, vtype):
         struct_class = _headType_StructTypeMap.get(vtype, None)
@@ -427,23 +387,93 @@ class JceSerializer(SerializerItf):
         else:
             raise JceDecodeError('unsupported vtype "%s"' % vtype)
 
+    def _load_lazy(self, vtype, struct_class):
+        '''跳过数据，返回延迟解码的值
+        '''
+        pos = self._buf.get_pos()
+        self._skip(vtype)
+        return LazyValue(self._load_at, self._buf.get_data(), pos, vtype, struct_class)
+
+    def _load_at(self, buf, pos, vtype, struct_class):
+        '''从指定位置解码，使用当前序列化器的副本和独立的缓冲区，不影响当前序列化器正在进行的解码
+        '''
+        serializer = copy.copy(self)
+        serializer._buf = BufferReader(buf, pos)
+        serializer.unknown_tag_count = 0
+        value = serializer._loads(struct_class, vtype)
+        self.unknown_tag_count += serializer.unknown_tag_count
+        return value
+
+    def _skip_unknown(self, struct_class, tag, vtype):
+        '''跳过未定义的tag，不解码数据
+        '''
+        if not self._ignore_unknown_field:
+            raise JceDecodeError('invalid tag value %d for structure "%s"' % (tag, struct_class.__name__))
+        self._skip(vtype)
+        self.unknown_tag_count += 1
+        if self._unknown_tag_handler is not None:
+            self._unknown_tag_handler(struct_class, tag, vtype)
+
+    def _skip(self, vtype):
+        '''按信息头类型跳过一个值
+        '''
+        size = _FIXED_SIZES.get(vtype)
+        if size is not None:
+            self._buf.skip(size)
+        elif vtype == DataHeadType.STRING1:
+            self._buf.skip(self._load_int8(DataHeadType.INT8, String, True))
+        elif vtype == DataHeadType.STRING4:
+            self._buf.skip(self._load_int32(DataHeadType.INT32, String, True))
+        elif vtype == DataHeadType.BYTES:
+            _vtype, _vtag = self._buf.read_head()
+            assert _vtype == DataHeadType.INT8
+            self._buf.skip(self._read_size())
+        elif vtype == DataHeadType.LIST:
+            for _ in range(self._read_size()):
+                self._skip(self._buf.read_head()[0])
+        elif vtype == DataHeadType.MAP:
+            for _ in range(self._read_size() * 2):
+                self._skip(self._buf.read_head()[0])
+        elif vtype == DataHeadType.STRUCTBEGIN:
+            while True:
+                evtype = self._buf.read_head()[0]
+                if evtype == DataHeadType.STRUCTEND:
+                    break
+                self._skip(evtype)
+        else:
+            raise JceDecodeError('unsupported vtype "%s"' % vtype)
+
+    def _read_size(self):
+        '''读取容器长度
+        '''
+        _vtype, _vtag = self._buf.read_head()
+        assert _vtag == 0
+        return self._load_int32(_vtype, Uint32, True)
+
     def _load_dict(self, vtype, struct_class):
         '''反序列化字典
         '''
         if vtype == DataHeadType.STRUCTBEGIN:
+            table = _JceFieldTable.get(struct_class)
+            if table.decoder is not None and self._use_codec:
+                return table.decoder(self, struct_class, table.types, True)
             dictdata = {}
+            tags = table.tags
             while True:
                 evtype, tag = self._buf.read_head()
                 if evtype == DataHeadType.STRUCTEND:
                     assert tag == 0
                     break
 
-                field = self._get_field(struct_class, tag)
-                if field is not None:
-                    dictdata[field.name] = self._loads(field.type, evtype)
+                entry = tags.get(tag)
+                if entry is not None:
+                    field, loader, composite = entry
+                    if composite and self._lazy:
+                        dictdata[field.name] = self._load_lazy(evtype, field.type)
+                    else:
+                        dictdata[field.name] = loader(self, evtype, field.type)
                 else:
-                    # dictdata['unknown_%s'%tag] = self._loads_unknown(evtype)
-                    self._loads_unknown(evtype)
+                    self._skip_unknown(struct_class, tag, evtype)
             return dictdata
         else:
             raise JceDecodeError('inconsistent type, structure is "%s", data head is "%d"' % (struct_class.__name__, vtype))
@@ -676,6 +706,157 @@ class JceSerializer(SerializerItf):
         return len(value.dumps(self))
 
 
+_DUMPERS = {
+    Dict: lambda self, tag, value, struct_class: self._dump_dict(tag, value, struct_class),
+    MapBase: lambda self, tag, value, struct_class: self._dump_map(tag, value, struct_class.key_struct, struct_class.value_struct),
+    ArrayBase: lambda self, tag, value, struct_class: self._dump_array(tag, value, struct_class.element_struct),
+    String: lambda self, tag, value, struct_class: self._dump_string(tag, value),
+    Buffer: lambda self, tag, value, struct_class: self._dump_buffer(tag, value),
+    Float: lambda self, tag, value, struct_class: self._dump_float(tag, value),
+    Double: lambda self, tag, value, struct_class: self._dump_double(tag, value),
+    Bool: lambda self, tag, value, struct_class: self._dump_bool(tag, value),
+    Uint64: lambda self, tag, value, struct_class: self._dump_int64(tag, value, True),
+    Int64: lambda self, tag, value, struct_class: self._dump_int64(tag, value, False),
+    Uint32: lambda self, tag, value, struct_class: self._dump_int32(tag, value, True),
+    Int32: lambda self, tag, value, struct_class: self._dump_int32(tag, value, False),
+    Uint16: lambda self, tag, value, struct_class: self._dump_int16(tag, value, True),
+    Int16: lambda self, tag, value, struct_class: self._dump_int16(tag, value, False),
+    Uint8: lambda self, tag, value, struct_class: self._dump_int8(tag, value, True),
+    Int8: lambda self, tag, value, struct_class: self._dump_int8(tag, value, False),
+}
+
+_LOADERS = {
+    Dict: lambda self, vtype, struct_class: self._load_dict(vtype, struct_class),
+    MapBase: lambda self, vtype, struct_class: self._load_map(vtype, struct_class, struct_class.key_struct, struct_class.value_struct),
+    ArrayBase: lambda self, vtype, struct_class: self._load_array(vtype, struct_class, struct_class.element_struct),
+    String: lambda self, vtype, struct_class: self._load_string(vtype, struct_class),
+    Buffer: lambda self, vtype, struct_class: self._load_buffer(vtype, struct_class),
+    Float: lambda self, vtype, struct_class: self._load_float(vtype, struct_class),
+    Double: lambda self, vtype, struct_class: self._load_double(vtype, struct_class),
+    Bool: lambda self, vtype, struct_class: self._load_bool(vtype, struct_class),
+    Uint64: lambda self, vtype, struct_class: self._load_int64(vtype, struct_class, True),
+    Int64: lambda self, vtype, struct_class: self._load_int64(vtype, struct_class, False),
+    Uint32: lambda self, vtype, struct_class: self._load_int32(vtype, struct_class, True),
+    Int32: lambda self, vtype, struct_class: self._load_int32(vtype, struct_class, False),
+    Uint16: lambda self, vtype, struct_class: self._load_int16(vtype, struct_class, True),
+    Int16: lambda self, vtype, struct_class: self._load_int16(vtype, struct_class, False),
+    Uint8: lambda self, vtype, struct_class: self._load_int8(vtype, struct_class, True),
+    Int8: lambda self, vtype, struct_class: self._load_int8(vtype, struct_class, False),
+}
+
+_COMPOSITE_TYPES = (Dict, MapBase, ArrayBase)
+
+
+def _find_codec(codecs, struct_class, cache=None):
+    '''按结构类型查找编解码函数，复合类型的子类的查找结果保存在cache中，不修改codecs
+    '''
+    codec = codecs.get(struct_class)
+    if codec is None and cache is not None:
+        codec = cache.get(struct_class)
+    if codec is None:
+        for base in _COMPOSITE_TYPES:
+            if issubclass(struct_class, base):
+                codec = codecs[base]
+                if cache is not None:
+                    cache[struct_class] = codec
+                break
+    return codec
+
+
+class _JceFieldTable(object):
+    '''JCE结构的tag索引表，按结构类型缓存
+    '''
+
+    def __init__(self, struct_class):
+        self.tags = {}
+        self.items = []
+        fields = struct_class.get_fields()
+        self.types = [field.type for field in fields]
+        self.encoder, self.decoder = _find_generated_codec(struct_class)
+        for field in fields:
+            tag = field.params['tag']
+            self.tags.setdefault(tag, (field, _find_codec(_LOADERS, field.type) or _unsupported_loader,
+                                       issubclass(field.type, _COMPOSITE_TYPES)))
+            dumper = _find_codec(_DUMPERS, field.type) or _unsupported_dumper
+            self.items.append((field.name, field.required, tag, field.type, dumper))
+
+    @classmethod
+    def get(cls, struct_class):
+        '''获取结构类型的tag索引表，只构建一次
+        '''
+        table = struct_class.__dict__.get('_jce_field_table_')
+        if table is None:
+            table = cls(struct_class)
+            setattr(struct_class, '_jce_field_table_', table)
+        return table
+
+
+def get_type_signature(struct_class):
+    '''获取结构类型的签名，用于校验生成的编解码函数是否与定义一致
+    '''
+    if issubclass(struct_class, ArrayBase):
+        return 'Array(%s)' % get_type_signature(struct_class.element_struct)
+    elif issubclass(struct_class, MapBase):
+        return 'Map(%s,%s)' % (get_type_signature(struct_class.key_struct), get_type_signature(struct_class.value_struct))
+    elif issubclass(struct_class, Dict) and struct_class._msgclass is not None:
+        return struct_class._msgclass.__name__
+    return struct_class.__name__
+
+
+def get_fields_signature(struct_class):
+    '''获取字典结构各个域的签名
+    '''
+    return tuple((field.name, field.params['tag'], field.required, get_type_signature(field.type))
+                 for field in struct_class.get_fields())
+
+
+_codec_modules = {}  # 消息定义模块名 => 生成的_codec模块，不存在时为None
+
+
+def _get_codec_module(module_name):
+    '''获取消息定义模块对应的_codec模块，只有代码生成器生成的模块才会使用
+
+    _codec模块不存在时返回None，_codec模块导入时出错则抛出异常
+    '''
+    if module_name in _codec_modules:
+        return _codec_modules[module_name]
+    codec_name = module_name + '_codec'
+    try:
+        loader = pkgutil.find_loader(codec_name)
+    except ImportError:  # 上级包无法导入
+        loader = None
+    module = None
+    if loader is not None:
+        module = importlib.import_module(codec_name)
+        if not getattr(module, '__jce_codec__', False):
+            module = None
+    _codec_modules[module_name] = module
+    return module
+
+
+def _find_generated_codec(struct_class):
+    '''查找消息定义模块对应的_codec模块中生成的编解码函数，定义不一致时不使用
+    '''
+    message_class = struct_class._msgclass
+    if message_class is None or struct_class.__module__ is None:
+        return None, None
+    module = _get_codec_module(struct_class.__module__)
+    if module is None:
+        return None, None
+    name = message_class.__name__
+    if getattr(module, 'FIELDS_' + name, None) != get_fields_signature(struct_class):
+        return None, None
+    return getattr(module, 'encode_' + name, None), getattr(module, 'decode_' + name, None)
+
+
+def _unsupported_dumper(self, tag, value, struct_class):
+    raise JceEncodeError('unsupported structure "%s"' % struct_class.__name__)
+
+
+def _unsupported_loader(self, vtype, struct_class):
+    raise JceDecodeError('unsupported structure "%s"' % struct_class.__name__)
+
+
 class Tab(object):
     '''缩进
     '''
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''JCE编解码函数生成器
+
+为JCE消息生成展开了tag和类型的编解码函数，写入与消息定义模块同名加_codec后缀的模块，
+JceSerializer会自动查找并使用这些函数，模块中没有生成器写入的__jce_codec__标记或消息定义与生成时不一致时不使用
+'''
+
+import imp
+import inspect
+import os
+import sys
+
+from qt4s.message.definition import Message, Dict, MapBase, ArrayBase, String, Buffer, Float, Double, Bool, \
+    Int8, Uint8, Int16, Uint16, Int32, Uint32, Int64, Uint64
+from qt4s.message.serializers.jce import DataHeadType, get_fields_signature
+
+_SCALAR_DUMPS = {
+    String: 's._dump_string(%(tag)d, %(value)s)',
+    Buffer: 's._dump_buffer(%(tag)d, %(value)s)',
+    Float: 's._dump_float(%(tag)d, %(value)s)',
+    Double: 's._dump_double(%(tag)d, %(value)s)',
+    Bool: 's._dump_bool(%(tag)d, %(value)s)',
+    Uint64: 's._dump_int64(%(tag)d, %(value)s, True)',
+    Int64: 's._dump_int64(%(tag)d, %(value)s, False)',
+    Uint32: 's._dump_int32(%(tag)d, %(value)s, True)',
+    Int32: 's._dump_int32(%(tag)d, %(value)s, False)',
+    Uint16: 's._dump_int16(%(tag)d, %(value)s, True)',
+    Int16: 's._dump_int16(%(tag)d, %(value)s, False)',
+    Uint8: 's._dump_int8(%(tag)d, %(value)s, True)',
+    Int8: 's._dump_int8(%(tag)d, %(value)s, False)',
+}
+
+_SCALAR_LOADS = {
+    String: 's._load_string(vtype, types[%(index)d])',
+    Buffer: 's._load_buffer(vtype, types[%(index)d])',
+    Float: 's._load_float(vtype, types[%(index)d])',
+    Double: 's._load_double(vtype, types[%(index)d])',
+    Bool: 's._load_bool(vtype, types[%(index)d])',
+    Uint64: 's._load_int64(vtype, types[%(index)d], True)',
+    Int64: 's._load_int64(vtype, types[%(index)d], False)',
+    Uint32: 's._load_int32(vtype, types[%(index)d], True)',
+    Int32: 's._load_int32(vtype, types[%(index)d], False)',
+    Uint16: 's._load_int16(vtype, types[%(index)d], True)',
+    Int16: 's._load_int16(vtype, types[%(index)d], False)',
+    Uint8: 's._load_int8(vtype, types[%(index)d], True)',
+    Int8: 's._load_int8(vtype, types[%(index)d], False)',
+}
+
+
+class JceCodecGenerator(object):
+    '''JCE编解码函数生成器
+    '''
+    header_text = """# -*- coding: utf-8 -*-
+#---------------------------------------------------
+#
+# 该文件由QT4S代码生成器自动生成，请不要编辑
+#
+# ---------------------------------------------------
+
+__jce_codec__ = True
+
+
+"""
+    tab = '    '
+
+    def generate(self, message_classes):
+        '''生成编解码函数代码
+
+        :param message_classes: JCE消息类型列表
+        :returns: Python代码
+        '''
+        lines = []
+        for message_class in message_classes:
+            lines += self._generate_message(message_class)
+        return self.header_text + '\n'.join(lines).rstrip() + '\n'
+
+    def _generate_message(self, message_class):
+        '''生成一个消息的编解码函数
+        '''
+        struct_class = message_class.get_struct_class()
+        name = message_class.__name__
+        signature = get_fields_signature(struct_class)
+        lines = ['FIELDS_%s = (' % name]
+        for it in signature:
+            lines.append('%s%r,' % (self.tab, it))
+        lines.append(')')
+        lines.append('')
+        lines.append('')
+        lines += self._generate_encoder(name, struct_class.get_fields())
+        lines.append('')
+        lines.append('')
+        lines += self._generate_decoder(name, struct_class.get_fields())
+        lines.append('')
+        lines.append('')
+        return lines
+
+    def _dump_expr(self, index, field, value):
+        '''生成一个域的序列化语句
+        '''
+        params = {'index': index, 'tag': field.params['tag'], 'value': value}
+        if field.type in _SCALAR_DUMPS:
+            return _SCALAR_DUMPS[field.type] % params
+        elif issubclass(field.type, Dict):
+            return 's._dump_dict(%(tag)d, %(value)s, types[%(index)d])' % params
+        elif issubclass(field.type, MapBase):
+            return 's._dump_map(%(tag)d, %(value)s, types[%(index)d].key_struct, types[%(index)d].value_struct)' % params
+        elif issubclass(field.type, ArrayBase):
+            return 's._dump_array(%(tag)d, %(value)s, types[%(index)d].element_struct)' % params
+        return 's._dumps(types[%(index)d], %(tag)d, %(value)s)' % params
+
+    def _load_expr(self, index, field):
+        '''生成一个域的反序列化表达式
+        '''
+        params = {'index': index}
+        if field.type in _SCALAR_LOADS:
+            return _SCALAR_LOADS[field.type] % params
+        elif issubclass(field.type, Dict):
+            return 's._load_dict(vtype, types[%(index)d])' % params
+        elif issubclass(field.type, MapBase):
+            return 's._load_map(vtype, types[%(index)d], types[%(index)d].key_struct, types[%(index)d].value_struct)' % params
+        elif issubclass(field.type, ArrayBase):
+            return 's._load_array(vtype, types[%(index)d], types[%(index)d].element_struct)' % params
+        return 's._loads(types[%(index)d], vtype)' % params
+
+    def _generate_encoder(self, name, fields):
+        '''生成序列化函数
+        '''
+        tab = self.tab
+        lines = ['def encode_%s(s, value, types):' % name]
+        for index, field in enumerate(fields):
+            if field.required:
+                lines.append(tab + self._dump_expr(index, field, 'value[%r]' % field.name))
+            else:
+                lines.append('%sif %r in value:' % (tab, field.name))
+                lines.append(tab * 2 + self._dump_expr(index, field, 'value[%r]' % field.name))
+        if not fields:
+            lines.append(tab + 'pass')
+        return lines
+
+    def _generate_decoder(self, name, fields):
+        '''生成反序列化函数
+        '''
+        tab = self.tab
+        lines = ['def decode_%s(s, struct_class, types, nested):' % name,
+                 tab + 'r = s._buf',
+                 tab + 'd = {}',
+                 tab + 'while nested or not r.is_eof():',
+                 tab * 2 + 'vtype, tag = r.read_head()',
+                 tab * 2 + 'if nested and vtype == %d:' % DataHeadType.STRUCTEND,
+                 tab * 3 + 'break']
+        for index, field in sorted(enumerate(fields), key=lambda it: it[1].params['tag']):
+            lines.append('%selif tag == %d:' % (tab * 2, field.params['tag']))
+            if issubclass(field.type, (Dict, MapBase, ArrayBase)):
+                lines.append(tab * 3 + 'if s._lazy:')
+                lines.append(tab * 4 + 'd[%r] = s._load_lazy(vtype, types[%d])' % (field.name, index))
+                lines.append(tab * 3 + 'else:')
+                lines.append(tab * 4 + 'd[%r] = %s' % (field.name, self._load_expr(index, field)))
+            else:
+                lines.append(tab * 3 + 'd[%r] = %s' % (field.name, self._load_expr(index, field)))
+        lines.append(tab * 2 + 'else:')
+        lines.append(tab * 3 + 's._skip_unknown(struct_class, tag, vtype)')
+        lines.append(tab + 'return d')
+        return lines
+
+
+def get_module_messages(module):
+    '''获取模块中定义的字典结构消息类型
+    '''
+    message_classes = []
+    for _, obj in inspect.getmembers(module, inspect.isclass):
+        if issubclass(obj, Message) and obj.__module__ == module.__name__ \
+            and issubclass(obj.get_struct_class(), Dict):
+            message_classes.append(obj)
+    message_classes.sort(key=lambda it: inspect.getsourcelines(it)[1])
+    return message_classes
+
+
+def generate_codec_file(filepath):
+    '''为生成的JCE消息定义文件生成对应的_codec文件
+
+    :param filepath: 消息定义文件路径，例如demo_jce.py
+    :returns: 生成的文件路径
+    '''
+    dirname = os.path.dirname(os.path.abspath(filepath))
+    modname = os.path.splitext(os.path.basename(filepath))[0]
+    sys.path.insert(0, dirname)  # for imports between generated files
+    try:
+        module = imp.load_source(modname, filepath)
+    finally:
+        sys.path.remove(dirname)
+    dstfile = os.path.join(dirname, modname + '_codec.py')
+    with open(dstfile, 'w') as fd:
+        fd.write(JceCodecGenerator().generate(get_module_messages(module)))
+    return dstfile
@@ -12,3 +12,9 @@ QT4S_NETWORK_AREA_DETECTORS = []
 
 QT4S_NETWORK_RULES = []
 
+# count of ioloop threads shared by socket connections
+QT4S_IOLOOP_POOL_SIZE = 1
+
+# how a connection is assigned to an ioloop, "hash" of its affinity_key or "least_load",
+# connections without affinity_key are always assigned to the least loaded ioloop
+QT4S_IOLOOP_POOL_POLICY = "hash"
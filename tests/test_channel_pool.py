@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""test cases for pooled socket channel
+"""
+import threading
+import time
+import unittest
+
+from qt4s.channel.future import gather
+from qt4s.channel.pool import PooledSocketChannel, EnumChannelPoolPolicy
+from qt4s.channel.sock import SocketConnectionClosedError
+from qt4s.connections.ioloop import IOLoopGroup, EnumIOLoopPolicy
+from tests.simple_servers import TcpEchoServer
+from tests.test_socket_channel import SeqChannel, SeqRequest
+
+
+class SeqPooledChannel(PooledSocketChannel):
+    channel_class = SeqChannel
+    reconnect_interval = 0.1
+
+
+class PooledSocketChannelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tcp_server = TcpEchoServer()
+        threading.Thread(name="tcp_server", target=cls.tcp_server.serve_forever, args=(0.1,)).start()
+        cls.tcp_host, cls.tcp_port = cls.tcp_server.server_address
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tcp_server.shutdown()
+
+    def _create_pool(self, **kwargs):
+        chan = SeqPooledChannel(host=self.tcp_host, port=self.tcp_port, pool_size=3, **kwargs)
+        self.addCleanup(chan.close)
+        return chan
+
+    def test_round_robin(self):
+        chan = self._create_pool(pool_policy=EnumChannelPoolPolicy.ROUND_ROBIN)
+        futures = [chan.send_async(SeqRequest(length=0, seq=i, buffer="x", timeout=5)) for i in range(30)]
+        self.assertEqual([rsp.seq for rsp in gather(futures, 5)], list(range(30)))
+        self.assertTrue(all(member.connected for member in chan.channels))
+        rsp = chan.request(length=0, seq=100, buffer="xxxx", timeout=5)
+        self.assertEqual(rsp.buffer, "xxxx")
+        self.assertEqual(rsp.request.seq, 100)
+
+    def test_spread_over_ioloops(self):
+        group = IOLoopGroup(3, EnumIOLoopPolicy.HASH)
+        self.addCleanup(group.stop)
+        orig_group, IOLoopGroup._instance = IOLoopGroup._instance, group
+        self.addCleanup(setattr, IOLoopGroup, "_instance", orig_group)
+        for chan in [self._create_pool(), self._create_pool(affinity_key="backend")]:
+            ioloops = set([member.get_connection().ioloop for member in chan.channels])
+            self.assertEqual(len(ioloops), 3)
+
+    def test_least_outstanding(self):
+        chan = self._create_pool()
+        members = chan.channels
+        rsp = chan.send(SeqRequest(length=0, seq=1, buffer="x", timeout=5))
+        self.assertEqual(rsp.seq, 1)
+        self.assertTrue(members[0].connected)
+        self.assertFalse(members[1].connected)
+
+    def test_reconnect(self):
+        chan = self._create_pool()
+        member = chan.channels[0]
+        member.send(SeqRequest(length=0, seq=1, buffer="x", timeout=5))
+        member._conn.close()
+        self.assertTrue(member.broken)
+        self.assertFalse(chan.get_channel() is member)
+        for _ in range(50):
+            if chan.channels[0] is not member:
+                break
+            time.sleep(0.1)
+        new_member = chan.channels[0]
+        self.assertFalse(new_member is member)
+        self.assertTrue(new_member.connected)
+        self.assertFalse(new_member.broken)
+
+    def test_closed(self):
+        chan = self._create_pool()
+        chan.close()
+        self.assertRaises(SocketConnectionClosedError, chan.get_channel)
+
+    def test_invalid_args(self):
+        self.assertRaises(ValueError, SeqPooledChannel, host=self.tcp_host, port=self.tcp_port, pool_size=0)
+        self.assertRaises(ValueError, SeqPooledChannel, host=self.tcp_host, port=self.tcp_port, pool_policy="xxx")
+        self.assertRaises(ValueError, PooledSocketChannel, host=self.tcp_host, port=self.tcp_port)
+
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="PooledSocketChannelTest")
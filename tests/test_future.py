@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""test cases for future
+"""
+import threading
+import unittest
+
+from qt4s.channel.future import Future, FutureTimeoutError, gather, wait_any
+
+
+class FutureTest(unittest.TestCase):
+
+    def test_result(self):
+        future = Future()
+        done = []
+        future.add_done_callback(done.append)
+        self.assertFalse(future.done())
+        self.assertRaises(FutureTimeoutError, future.result, 0.01)
+        threading.Timer(0.05, future.set_result, args=(1,)).start()
+        self.assertEqual(future.result(5), 1)
+        self.assertEqual(done, [future])
+        self.assertFalse(future.set_result(2))
+        self.assertEqual(future.result(), 1)
+        self.assertEqual(future.exception(), None)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+
+    def test_exception(self):
+        future = Future()
+        future.set_exception(ValueError("xxx"))
+        self.assertRaises(ValueError, future.result)
+        self.assertTrue(isinstance(future.exception(), ValueError))
+
+    def test_gather(self):
+        futures = [Future() for _ in range(3)]
+        for i, future in enumerate(futures):
+            threading.Timer(0.01 * (3 - i), future.set_result, args=(i,)).start()
+        self.assertEqual(gather(futures, 5), [0, 1, 2])
+        self.assertRaises(FutureTimeoutError, gather, [Future()], 0.01)
+
+    def test_wait_any(self):
+        futures = [Future() for _ in range(3)]
+        self.assertEqual(wait_any(futures, 0.01), None)
+        threading.Timer(0.05, futures[1].set_result, args=(1,)).start()
+        self.assertTrue(wait_any(futures, 5) is futures[1])
+        self.assertEqual(futures[0]._callbacks, [])
+
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="FutureTest")
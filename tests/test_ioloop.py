@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 """test cases for ioloop
 """
+import select
+import socket
+import sys
+import threading
+import time
 import unittest
 
-from qt4s.connections.ioloop import IOLoopBase
+from qt4s.connections.ioloop import IOLoopBase, SelectIOLoop, PollIOLoop, EpollIOLoop, DEFAULT_IOLOOP_CLS, \
+    IOLoopGroup, EnumIOLoopPolicy
+from qt4s.connections.sock import SocketConn, SocketCallback
 
 
 class IOLoopTest(unittest.TestCase):
@@ -23,6 +30,151 @@ class IOLoopTest(unittest.TestCase):
         self.assertRaises(ValueError, ioloop.register_fd, fd, None, cb, cb)
 
 
+    def _check_echo(self, ioloop_cls):
+        ioloop = ioloop_cls()
+        self.addCleanup(ioloop.stop)
+        r, w = socket.socketpair()
+        evt = threading.Event()
+        received = []
+
+        def on_read():
+            received.append(r.recv(1024))
+            evt.set()
+
+        ioloop.register_fd(r, on_read, lambda: None, lambda e, stack: None)
+        ioloop.start()
+        w.send("xxxx")
+        evt.wait(5)
+        self.assertEqual(received, ["xxxx"])
+        return ioloop, r, w
+
+    def _check_remove(self, ioloop_cls):
+        ioloop, r, w = self._check_echo(ioloop_cls)
+        ioloop.remove_fd(r)  # removing is synchronous for poll based ioloop
+        r.close()
+        w.close()
+        r, w = socket.socketpair()  # fileno is reused
+        self.addCleanup(r.close)
+        self.addCleanup(w.close)
+        evt = threading.Event()
+        ioloop.register_fd(r, evt.set, lambda: None, lambda e, stack: None)
+        w.send("xxxx")
+        self.assertTrue(evt.wait(5))
+
+    def _check_register_while_polling(self, ioloop_cls):
+        ioloop, r, w = self._check_echo(ioloop_cls)
+        self.addCleanup(r.close)
+        self.addCleanup(w.close)
+        time.sleep(0.2)  # ioloop thread is blocked in polling without timers
+        r2, w2 = socket.socketpair()
+        self.addCleanup(r2.close)
+        self.addCleanup(w2.close)
+        w2.send("xxxx")  # readable before registering, no more events will come
+        evt = threading.Event()
+        ioloop.register_fd(r2, evt.set, lambda: None, lambda e, stack: None)
+        self.assertTrue(evt.wait(5))
+
+    def test_select_ioloop(self):
+        self._check_echo(SelectIOLoop)
+
+    @unittest.skipUnless(hasattr(select, "poll"), "poll is not available")
+    def test_poll_ioloop(self):
+        self._check_remove(PollIOLoop)
+        self._check_register_while_polling(PollIOLoop)
+
+    @unittest.skipUnless(hasattr(select, "epoll"), "epoll is not available")
+    def test_epoll_ioloop(self):
+        self._check_remove(EpollIOLoop)
+        self._check_register_while_polling(EpollIOLoop)
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "linux only")
+    def test_default_ioloop(self):
+        self.assertEqual(DEFAULT_IOLOOP_CLS, EpollIOLoop)
+
+
+class IOLoopTimerTest(unittest.TestCase):
+
+    def _check_timers(self, ioloop_cls):
+        ioloop = ioloop_cls()
+        self.addCleanup(ioloop.stop)
+        ioloop.start()
+        evt = threading.Event()
+        fired = []
+        ioloop.call_later(0.2, fired.append, 2)
+        ioloop.call_later(0.3, evt.set)
+        ioloop.call_later(0.1, fired.append, 1)
+        timer = ioloop.call_later(0.15, fired.append, 3)
+        timer.cancel()
+        ioloop.call_at(time.time() - 1, fired.append, 0)
+        self.assertTrue(evt.wait(5))
+        self.assertEqual(fired, [0, 1, 2])
+
+    def test_select_timers(self):
+        self._check_timers(SelectIOLoop)
+
+    def test_default_timers(self):
+        self._check_timers(DEFAULT_IOLOOP_CLS)
+
+    def test_compact_cancelled(self):
+        ioloop = IOLoopBase()
+        timers = [ioloop.call_later(100, lambda: None) for _ in range(1000)]
+        for timer in timers:
+            timer.cancel()
+        self.assertTrue(len(ioloop._timers) < 1000)
+        self.assertEqual(ioloop._run_timers(), None)
+
+
+class IOLoopGroupTest(unittest.TestCase):
+
+    def test_single_ioloop(self):
+        group = IOLoopGroup(1)
+        self.assertTrue(group.get_ioloop(object()) is DEFAULT_IOLOOP_CLS.instance())
+
+    def test_hash_policy(self):
+        group = IOLoopGroup(4, EnumIOLoopPolicy.HASH)
+        self.addCleanup(group.stop)
+        self.assertEqual(group.size, 4)
+        key = ("127.0.0.1", 80)
+        self.assertTrue(group.get_ioloop(key) is group.get_ioloop(key))
+        ioloops = set([group.get_ioloop(i) for i in range(4)])
+        self.assertEqual(len(ioloops), 4)
+
+    def test_connection_affinity(self):
+        group = IOLoopGroup(4, EnumIOLoopPolicy.HASH)
+        self.addCleanup(group.stop)
+        orig_group, IOLoopGroup._instance = IOLoopGroup._instance, group
+        self.addCleanup(setattr, IOLoopGroup, "_instance", orig_group)
+
+        def create_conn(port, **kwargs):
+            address = {"host": "127.0.0.1", "port": port, "proto": "TCP"}
+            address.update(kwargs)
+            return SocketConn(address, SocketCallback())
+
+        self.assertTrue(create_conn(80, affinity_key=1).ioloop is create_conn(81, affinity_key=1).ioloop)
+        ioloops = set([create_conn(80, affinity_key=i).ioloop for i in range(4)])
+        self.assertEqual(len(ioloops), 4)
+        r, w = socket.socketpair()
+        self.addCleanup(r.close)
+        self.addCleanup(w.close)
+        ioloop = create_conn(80).ioloop
+        ioloop.register_fd(r, lambda: None, lambda: None, lambda e, stack: None)
+        self.assertTrue(create_conn(80).ioloop is not ioloop)  # least load without affinity key
+
+    def test_least_load_policy(self):
+        group = IOLoopGroup(2, EnumIOLoopPolicy.LEAST_LOAD)
+        self.addCleanup(group.stop)
+        r, w = socket.socketpair()
+        self.addCleanup(r.close)
+        self.addCleanup(w.close)
+        ioloop = group.get_ioloop()
+        ioloop.register_fd(r, lambda: None, lambda: None, lambda e, stack: None)
+        self.assertTrue(group.get_ioloop() is not ioloop)
+
+    def test_invalid_args(self):
+        self.assertRaises(ValueError, IOLoopGroup, 0)
+        self.assertRaises(ValueError, IOLoopGroup, 2, "random")
+
+
 if __name__ == "__main__":
     unittest.main(defaultTest="IOLoopTest")
 
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#---------------------------------------------------
+#
+# 该文件由QT4S代码生成器自动生成，请不要编辑
+#
+# ---------------------------------------------------
+
+__jce_codec__ = True
+
+
+FIELDS_DemoJce = (
+    ('id', 0, False, 'Int64'),
+    ('name', 1, False, 'String'),
+    ('array', 2, False, 'Array(Int64)'),
+    ('mapping', 3, False, 'Map(String,Int64)'),
+)
+
+
+def encode_DemoJce(s, value, types):
+    if 'id' in value:
+        s._dump_int64(0, value['id'], False)
+    if 'name' in value:
+        s._dump_string(1, value['name'])
+    if 'array' in value:
+        s._dump_array(2, value['array'], types[2].element_struct)
+    if 'mapping' in value:
+        s._dump_map(3, value['mapping'], types[3].key_struct, types[3].value_struct)
+
+
+def decode_DemoJce(s, struct_class, types, nested):
+    r = s._buf
+    d = {}
+    while nested or not r.is_eof():
+        vtype, tag = r.read_head()
+        if nested and vtype == 11:
+            break
+        elif tag == 0:
+            d['id'] = s._load_int64(vtype, types[0], False)
+        elif tag == 1:
+            d['name'] = s._load_string(vtype, types[1])
+        elif tag == 2:
+            if s._lazy:
+                d['array'] = s._load_lazy(vtype, types[2])
+            else:
+                d['array'] = s._load_array(vtype, types[2], types[2].element_struct)
+        elif tag == 3:
+            if s._lazy:
+                d['mapping'] = s._load_lazy(vtype, types[3])
+            else:
+                d['mapping'] = s._load_map(vtype, types[3], types[3].key_struct, types[3].value_struct)
+        else:
+            s._skip_unknown(struct_class, tag, vtype)
+    return d
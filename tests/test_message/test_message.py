@@ -37,6 +37,20 @@ class Mother2(Message):
     ]
 
 
+class GrownBaby(Baby):
+    _struct_ = [
+        Field("class", String, display="klass", optional=True),
+    ]
+
+
+class Command(Message):
+    _struct_ = [
+        Field("dumps", String, optional=True),
+        Field("loads", String, optional=True),
+        Field("name", String, optional=True),
+    ]
+
+
 class DictStructTest(unittest.TestCase):
 
     def setUp(self):
@@ -137,6 +151,38 @@ class DictStructTest(unittest.TestCase):
         self.assertEqual(monther2.baby.name, 'jojo')
         self.assertEqual(monther2.baby.age, 2)
 
+    def test_field_index(self):
+        struct_class = GrownBaby.get_struct_class()
+        index = struct_class.get_field_index()
+        self.assertEqual(sorted(index.keys()), ["age", "class", "klass", "name"])
+        self.assertTrue(index["klass"] is index["class"])
+        self.assertTrue(struct_class.get_field_index() is index)
+        baby = GrownBaby()
+        baby.name = "jojo"
+        baby.klass = "one"
+        self.assertEqual(baby.klass, "one")
+        self.assertEqual(baby.dumps(), {"name": "jojo", "class": "one"})
+        self.assertRaises(TypeError, setattr, baby, "grade", 1)
+        self.assertRaises(AttributeError, getattr, baby, "grade")
+
+    def test_field_accessor(self):
+        baby = GrownBaby()
+        self.assertRaises(AttributeError, getattr, baby, "name")
+        baby.name = "jojo"
+        baby.klass = "one"
+        self.assertEqual(baby.get_struct().name, "jojo")
+        self.assertEqual((baby.name, baby.klass), ("jojo", "one"))
+        baby._private__data = 1
+        self.assertEqual(baby._private__data, 1)
+        self.assertRaises(TypeError, setattr, baby, "grade", 1)
+
+        cmd = Command()
+        cmd.name = "x"
+        self.assertTrue(callable(cmd.dumps))  # methods are not shadowed by fields
+        self.assertEqual(cmd.dumps(), {"name": "x"})
+        cmd.get_struct().dumps = "y"
+        self.assertEqual(cmd.dumps(), {"name": "x", "dumps": "y"})
+
 
 class SingleNumber(Message):
     _struct_ = Int64
@@ -175,6 +221,12 @@ class NonDictStructTest(unittest.TestCase):
         n.loads(888)
         self.assertEqual(n.value, 888)
 
+    def test_compact_scalars(self):
+        mother = Mother(name="alice", age=32, alive=True)
+        for name in ["name", "age", "alive"]:
+            self.assertFalse(hasattr(mother.get_struct()._Dict__ddict[name], "__dict__"))
+        self.assertRaises(AttributeError, setattr, mother.get_struct()._Dict__ddict["age"], "extra", 1)
+
 
 class Carrage(Message):
     _struct_ = [
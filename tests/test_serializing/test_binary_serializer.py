@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import array
 import unittest
 
-from qt4s.message.definition import Message, Uint32, Array, Map, Double, String, Field, Uint8, Float, Buffer
+from qt4s.message.definition import Message, Uint32, Array, Map, Double, String, Field, Uint8, Float, Buffer, \
+    Int16, Uint16, Uint64
 from qt4s.message.utils import size_of, offset_of, field_size_of
-from qt4s.message.serializers.binary import BinarySerializer
+from qt4s.message.serializers.binary import BinarySerializer, BinaryEndian, BinaryDecodeError, DictCodecPlan, \
+    BinaryLayout
 from rsa.common import byte_size
 
 
@@ -114,8 +117,41 @@ class SizeOfTest(unittest.TestCase):
         self.assertEqual(field_size_of(self.foo, "bar.byte_len_string.string", BinarySerializer()), 7)
         self.assertEqual(field_size_of(self.foo, "bar.byte_len_string", BinarySerializer()), 8)
 
+    def test_static_layout(self):
+        layout = BinaryLayout.get(FooMessage.get_struct_class())
+        self.assertTrue(BinaryLayout.get(FooMessage.get_struct_class()) is layout)
+        self.assertEqual(layout.prefix_count, 2)
+        self.assertEqual(layout.prefix_size, 17)
+        self.assertEqual(layout.size, None)
+        self.assertEqual(layout.offsets[:3], [0, 16, 17])
+        header_layout = BinaryLayout.get(FixedHeader.get_struct_class())
+        self.assertEqual(header_layout.prefix_size, 14)
+        self.assertEqual(offset_of(self.foo, "len", BinarySerializer()), 41)
+        self.assertEqual(offset_of(self.foo, "bar.byte_len_string.string", BinarySerializer()), 81)
+        self.assertEqual(size_of(self.foo, BinarySerializer()), 88)
+        self.assertEqual(len(self.foo.dumps(BinarySerializer())), 88)
+        self.assertRaises(ValueError, offset_of, self.foo, "xxx", BinarySerializer())
+        self.assertRaises(ValueError, field_size_of, self.foo, "bar.xxx", BinarySerializer())
+
+
+class UnicodeMessage(Message):
+    _struct_ = [
+        Field("len", Uint8),
+        Field("text", String, size_ref="len", encoding="unicode"),
+    ]
+
 
 class SerializingTest(unittest.TestCase):
+
+    def test_unicode_string(self):
+        msg = UnicodeMessage()
+        msg.len = 3
+        msg.text = u"abc"
+        data = msg.dumps(BinarySerializer())
+        self.assertEqual(data, "\x03abc")
+        loaded = UnicodeMessage()
+        loaded.loads(data, BinarySerializer())
+        self.assertEqual(loaded.text, u"abc")
     """test serializing
     """
 
@@ -166,6 +202,208 @@ class SerializingTest(unittest.TestCase):
         self.assertEqual(loaded_buff.buff2, "1234567")
 
 
+class FixedHeader(Message):
+    _struct_ = [
+        Field("magic", Uint16),
+        Field("version", Uint8),
+        Field("flag", Int16),
+        Field("seq", Uint64),
+        Field("name_len", Uint8),
+        Field("name", String, size_ref="name_len"),
+        Field("checksum", Uint32),
+        Field("reserved", Uint32, optional=True)
+    ]
+
+
+class CodecPlanTest(unittest.TestCase):
+
+    def test_fixed_fields_merged(self):
+        struct_class = FixedHeader.get_struct_class()
+        plan = DictCodecPlan.get(struct_class, BinaryEndian.Network)
+        self.assertTrue(DictCodecPlan.get(struct_class, BinaryEndian.Network) is plan)
+        self.assertEqual([it.names if hasattr(it, "names") else it.name for it in plan.steps],
+                         [("magic", "version", "flag", "seq", "name_len"), "name", ("checksum",), "reserved"])
+        self.assertEqual(plan.steps[0].struct.size, 14)
+
+    def _check_round_trip(self, endian):
+        header = FixedHeader()
+        header.magic = 0x1234
+        header.version = 2
+        header.flag = -3
+        header.seq = 0x123456789
+        header.name_len = 3
+        header.name = "abc"
+        header.checksum = 0xffffffff
+        data = header.dumps(BinarySerializer(endian))
+        self.assertEqual(len(data), 21)
+        loaded = FixedHeader()
+        loaded.loads(data, BinarySerializer(endian))
+        self.assertEqual(loaded.seq, 0x123456789)
+        self.assertEqual(loaded.flag, -3)
+        self.assertEqual(loaded.name, "abc")
+        self.assertEqual(loaded.checksum, 0xffffffff)
+        loaded.loads(data + "\x00\x00\x00\x01", BinarySerializer(endian))
+        self.assertEqual(loaded.reserved, 1 if endian != BinaryEndian.LittleEndian else 1 << 24)
+        self.assertRaises(BinaryDecodeError, loaded.loads, data[:10], BinarySerializer(endian))
+
+    def test_round_trip(self):
+        self._check_round_trip(BinaryEndian.Network)
+        self._check_round_trip(BinaryEndian.LittleEndian)
+
+
+class DecodeTracingTest(unittest.TestCase):
+
+    def test_replay_with_tracing(self):
+        data = FixedHeader(magic=1, version=2, flag=3, seq=4, name_len=3, name="abc", checksum=5).dumps(BinarySerializer())
+        try:
+            FixedHeader().loads(data[:16], BinarySerializer())
+        except BinaryDecodeError as e:
+            self.assertTrue("-magic 0001(1)" in str(e))
+            self.assertTrue("-seq 0000000000000004(4)" in str(e))
+        else:
+            self.fail("BinaryDecodeError not raised")
+
+    def test_always_tracing(self):
+        serializer = BinarySerializer(trace=True)
+        header = FixedHeader()
+        header.loads(FixedHeader(magic=1, version=2, flag=3, seq=4, name_len=1, name="a", checksum=5).dumps(serializer),
+                     serializer)
+        self.assertEqual(header.checksum, 5)
+
+
+class NumericArrays(Message):
+    _struct_ = [
+        Field("count", Uint32),
+        Field("values", Array(Uint32), size_ref="count"),
+        Field("pair", Array(Int16), array_size=2),
+        Field("tail", Array(Double), array_size=0)
+    ]
+
+
+class NumericArrayTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        msg = NumericArrays()
+        msg.values = list(range(100000))
+        msg.pair = [-1, 1]
+        msg.tail = [0.5, 1.5]
+        data = msg.dumps(BinarySerializer())
+        self.assertEqual(msg.count, 100000)
+        self.assertEqual(len(data), 4 + 400000 + 4 + 16)
+        loaded = NumericArrays()
+        loaded.loads(data, BinarySerializer(BinaryEndian.Network))
+        self.assertEqual(loaded.values[99999], 99999)
+        self.assertEqual(len(loaded.values), 100000)
+        self.assertEqual(list(loaded.pair), [-1, 1])
+        self.assertEqual(list(loaded.tail), [0.5, 1.5])
+        self.assertRaises(BinaryDecodeError, loaded.loads, data + "\x00", BinarySerializer())
+
+    def test_typed_storage(self):
+        msg = NumericArrays()
+        msg.values = [1, 2, 2 ** 32]
+        msg.pair = [-1, 1]
+        msg.tail = [0.5]
+        self.assertIsInstance(msg.values.get_values(), array.array)
+        self.assertRaises(ValueError, setattr, msg, "values", [-1])
+        self.assertRaises(ValueError, setattr, msg, "values", [1.0])
+        self.assertRaises(ValueError, msg.tail.append, "x")
+        self.assertEqual(list(msg.values), [1, 2, 2 ** 32])
+        self.assertEqual(msg.values, [1, 2, 2 ** 32])
+        msg.tail.append(2)
+        self.assertEqual(msg.tail.get_values(), [0.5, 2])
+        self.assertEqual(type(msg.tail[1]), int)
+        msg.values[2] = 3
+        for endian in [BinaryEndian.Native, BinaryEndian.LittleEndian, BinaryEndian.Network]:
+            serializer = BinarySerializer(endian)
+            data = msg.dumps(serializer)
+            self.assertEqual(data, serializer.dumps(NumericArrays.get_struct_class(), msg.get_struct().reduce()))
+            loaded = NumericArrays()
+            loaded.loads(data, serializer)
+            self.assertEqual(loaded.values, msg.values)
+            self.assertEqual(loaded.pair, [-1, 1])
+            self.assertEqual(loaded.tail, [0.5, 2.0])
+            data, _ = serializer.loads(NumericArrays.get_struct_class(), data)
+            self.assertEqual(type(data["values"]), list)
+
+    def test_compare_arrays(self):
+        msg = NumericArrays()
+        msg.values = [1, 2]
+        other = NumericArrays()
+        other.values = [1, 2]
+        self.assertEqual(msg.values, other.values)
+        other.values = [1, 3]
+        self.assertNotEqual(msg.values, other.values)
+        msg.pair = [1, 2]  # Int16 elements
+        self.assertFalse(msg.pair == other.values)
+        msg.tail = [1.0, 2.0]  # Double elements
+        self.assertFalse(msg.values == msg.tail)
+
+
+class DuckSerializer(object):
+    field_size_of_support = False
+
+    def dumps(self, struct_class, value):
+        return BinarySerializer().dumps(struct_class, value)
+
+
+class DuckInner(Message):
+    _struct_ = [
+        Field("value", Uint16),
+    ]
+
+
+class DuckFieldMessage(Message):
+    _struct_ = [
+        Field("tag", Uint8),
+        Field("inner", DuckInner, serializer=DuckSerializer()),
+    ]
+
+
+class DirectEncodingTest(unittest.TestCase):
+
+    def _make_foo(self):
+        foo = FooMessage()
+        foo.cmd = "login"
+        foo.username = "alice"
+        foo.timestamp = 1.5
+        foo.double_data = 2.5
+        foo.seq = 1
+        foo.len = 0
+        foo.uint32_list = [1, 2, 3, 4, 5]
+        foo.string_list = [ByteLenString(len=1, string="a"), ByteLenString(len=2, string="bc")]
+        foo.bar.byte_len_string.string = "xyz"
+        foo.bar.byte_len_string.len = 3
+        return foo
+
+    def test_same_as_reduce(self):
+        serializer = BinarySerializer()
+        foo = self._make_foo()
+        data = foo.dumps(serializer)
+        self.assertEqual(data, serializer.dumps(FooMessage.get_struct_class(), foo.get_struct().reduce()))
+        self.assertEqual(data[:16], "login" + "\x00" * 11)
+        loaded = FooMessage()
+        loaded.loads(data, serializer)
+        self.assertEqual(loaded.version, 0)
+        self.assertEqual(loaded.string_list[1].string, "bc")
+        self.assertEqual(loaded.bar.byte_len_string.string, "xyz")
+
+    def test_duck_typed_serializer(self):
+        foo = self._make_foo()
+        data = foo.dumps(BinarySerializer())
+        self.assertEqual(foo.dumps(DuckSerializer()), data)
+
+    def test_duck_typed_field_serializer(self):
+        msg = DuckFieldMessage()
+        msg.tag = 7
+        msg.inner.value = 0x0102
+        self.assertEqual(msg.dumps(BinarySerializer(BinaryEndian.BigEndian)), "\x07\x01\x02")
+
+    def test_required_field(self):
+        foo = self._make_foo()
+        foo.get_struct()._Dict__ddict.pop("seq")
+        self.assertRaises(ValueError, foo.dumps, BinarySerializer())
+
+
 if __name__ == "__main__":
     unittest.main(defaultTest="SerializingTest.test_load_byte_sized")
 #     unittest.main()
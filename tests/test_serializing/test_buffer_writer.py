@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import struct
+import unittest
+
+from qt4s.message.serializer import BufferWriter
+
+
+class BufferWriterTest(unittest.TestCase):
+
+    def test_write(self):
+        writer = BufferWriter(4)
+        writer.write_data("abc")
+        writer.write_struct(struct.Struct("!I"), 1)
+        writer.write_data("x" * 100)
+        self.assertEqual(writer.get_pos(), 107)
+        self.assertEqual(writer.get_buffer(0, 3), "abc")
+        self.assertEqual(writer.get_buffer(3, 7), "\x00\x00\x00\x01")
+        data = writer.detach()
+        self.assertEqual(type(data), str)
+        self.assertEqual(data, "abc\x00\x00\x00\x01" + "x" * 100)
+
+    def test_write_unicode(self):
+        writer = BufferWriter()
+        writer.write_data(u"abc")
+        self.assertEqual(writer.detach(), "abc")
+        self.assertRaises(ValueError, BufferWriter().write_data, u"\u4e2d")
+
+    def test_reserve_and_pack_into(self):
+        length_struct = struct.Struct("!H")
+        writer = BufferWriter()
+        offset = writer.reserve(length_struct.size)
+        writer.write_data("hello")
+        writer.pack_into(length_struct, offset, writer.get_pos())
+        self.assertRaises(ValueError, writer.pack_into, length_struct, writer.get_pos() - 1, 0)
+        view = writer.detach_view()
+        self.assertTrue(isinstance(view, memoryview))
+        self.assertEqual(view.tobytes(), "\x00\x07hello")
+
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="BufferWriterTest")
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from qt4s.message.definition import Message, Field, Array, Map, String, Buffer, Bool, Int32, Uint64, Double, \
+    LazyValue
+from qt4s.message.serializers.jce import JceSerializer, JceDecodeError, BufferWriter, BufferReader, _JceFieldTable, \
+    _find_generated_codec, _DUMPERS, _LOADERS
+from qt4s.message.serializers.jce_codec import JceCodecGenerator
+from tests.test_message.demo_jce import DemoJce
+
+
+class JceItem(Message):
+    _struct_ = [
+        Field("flag", Bool, tag=0),
+        Field("score", Double, tag=1),
+    ]
+
+
+class JceResponse(Message):
+    _struct_ = [
+        Field("code", Int32, tag=0),
+        Field("data", Buffer, tag=1),
+        Field("items", Array(JceItem), tag=2),
+        Field("extra", Map(String, Uint64), tag=20, optional=True),
+        Field("note", String, tag=21, optional=True),
+        Field("item", JceItem, tag=22, optional=True),
+    ]
+
+
+class JceItemV1(Message):
+    _struct_ = [
+        Field("score", Double, tag=1),
+    ]
+
+
+class JceResponseV1(Message):
+    _struct_ = [
+        Field("code", Int32, tag=0),
+        Field("items", Array(JceItemV1), tag=2),
+    ]
+
+
+class JceText(Message):
+    _struct_ = [
+        Field("text", String, tag=0, encoding="unicode"),
+    ]
+
+
+class JceDuplicateTag(Message):
+    _struct_ = [
+        Field("first", Int32, tag=0),
+        Field("second", String, tag=0, optional=True),
+    ]
+
+
+class JceSerializerTest(unittest.TestCase):
+
+    def _make_response(self):
+        rsp = JceResponse()
+        rsp.code = -70000
+        rsp.data = "\x00\x01\x02"
+        rsp.items = [JceItem(True, 1.5), JceItem(False, 0)]
+        rsp.extra = {"big": 1 << 40}
+        rsp.note = "x" * 300
+        rsp.item = JceItem(True, 2.5)
+        return rsp
+
+    def test_dumps_and_loads(self):
+        buff = self._make_response().dumps(JceSerializer())
+        rsp = JceResponse()
+        rsp.loads(buff, JceSerializer())
+        self.assertEqual(rsp.code, -70000)
+        self.assertEqual(rsp.data, "\x00\x01\x02")
+        self.assertEqual(rsp.items[0].flag, True)
+        self.assertEqual(rsp.items[0].score, 1.5)
+        self.assertEqual(rsp.items[1].flag, False)
+        self.assertEqual(rsp.extra["big"], 1 << 40)
+
+    def test_unicode_string(self):
+        msg = JceText()
+        msg.text = u"foo"
+        data = msg.dumps(JceSerializer())
+        self.assertEqual(data, "\x06\x03foo")
+        loaded = JceText()
+        loaded.loads(data, JceSerializer())
+        self.assertEqual(loaded.text, u"foo")
+
+    def test_field_table(self):
+        struct_class = JceResponse.get_struct_class()
+        self.assertTrue(struct_class.get_fields() is struct_class.get_fields())
+        serializer = JceSerializer()
+        self.assertEqual(serializer._get_field(struct_class, 20).name, "extra")
+        self.assertEqual(serializer._get_field(struct_class, 3), None)
+        self.assertRaises(JceDecodeError, JceSerializer(ignore_unknown_tag=False)._get_field, struct_class, 3)
+
+    def test_duplicate_tag(self):
+        struct_class = JceDuplicateTag.get_struct_class()
+        self.assertEqual(JceSerializer()._get_field(struct_class, 0).name, "first")
+        msg = JceDuplicateTag()
+        msg.first = 7
+        loaded = JceDuplicateTag()
+        loaded.loads(msg.dumps(JceSerializer()), JceSerializer(use_codec=False))
+        self.assertEqual(loaded.first, 7)
+
+    def test_codec_cache(self):
+        class CachedSerializer(JceSerializer):
+            pass
+
+        buff = self._make_response().dumps(CachedSerializer())
+        JceResponse().loads(buff, CachedSerializer(use_codec=False))
+        item_class = JceItem.get_struct_class()
+        self.assertFalse(item_class in _DUMPERS or item_class in _LOADERS)
+        cache = CachedSerializer._get_codec_cache("_jce_loader_cache_")
+        self.assertTrue(item_class in cache)
+        self.assertFalse(cache is JceSerializer._get_codec_cache("_jce_loader_cache_"))
+
+    def test_unknown_tag(self):
+        demo = DemoJce()
+        demo.id = 1
+        demo.name = "foo"
+        buff = demo.dumps(JceSerializer())
+        self.assertRaises(JceDecodeError, JceSerializer(ignore_unknown_tag=False).loads,
+                          JceItem.get_struct_class(), buff)
+
+    def test_skip_unknown_tags(self):
+        buff = self._make_response().dumps(JceSerializer())
+        unknown_tags = []
+        serializer = JceSerializer(unknown_tag_handler=lambda struct_class, tag, vtype: unknown_tags.append(tag))
+        rsp = JceResponseV1()
+        rsp.loads(buff, serializer)
+        self.assertEqual(rsp.code, -70000)
+        self.assertEqual([item.score for item in rsp.items], [1.5, 0])
+        self.assertEqual(sorted(unknown_tags), [0, 0, 1, 20, 21, 22])
+        self.assertEqual(serializer.unknown_tag_count, 6)
+
+    def test_lazy_loads(self):
+        buff = self._make_response().dumps(JceSerializer())
+        rsp = JceResponse()
+        rsp.loads(buff, JceSerializer(lazy=True))
+        ddict = rsp.get_struct()._Dict__ddict
+        self.assertTrue(isinstance(ddict["items"], LazyValue))
+        self.assertTrue(isinstance(ddict["item"], LazyValue))
+        self.assertEqual(rsp.code, -70000)
+        self.assertEqual(rsp.item.score, 2.5)
+        self.assertFalse(isinstance(ddict["item"], LazyValue))
+        self.assertTrue(isinstance(ddict["extra"], LazyValue))
+
+        eager_rsp = JceResponse()
+        eager_rsp.loads(buff, JceSerializer())
+        self.assertEqual(rsp.reduce(), eager_rsp.reduce())
+        self.assertEqual(rsp.dumps(JceSerializer()), buff)
+
+    def test_lazy_loads_isolated(self):
+        buff = self._make_response().dumps(JceSerializer())
+        readers = []
+        serializer = JceSerializer(lazy=True,
+                                   unknown_tag_handler=lambda struct_class, tag, vtype: readers.append(serializer._buf))
+        rsp = JceResponseV1()
+        rsp.loads(buff, serializer)
+        del readers[:]
+        reader = serializer._buf = BufferReader("")  # serializer is decoding something else
+        self.assertEqual([item.score for item in rsp.items], [1.5, 0])
+        self.assertEqual(readers, [reader, reader])
+        self.assertEqual(serializer.unknown_tag_count, 6)
+
+    def test_lazy_loads_subclass(self):
+        buff = self._make_response().dumps(JceSerializer())
+
+        class ScaledSerializer(JceSerializer):
+
+            def __init__(self, scale, **kwargs):
+                super(ScaledSerializer, self).__init__(**kwargs)
+                self.scale = scale
+
+            def _load_double(self, vtype, struct_class):
+                return super(ScaledSerializer, self)._load_double(vtype, struct_class) * self.scale
+
+        rsp = JceResponse()
+        rsp.loads(buff, ScaledSerializer(2, lazy=True, use_codec=False))
+        self.assertEqual([item.score for item in rsp.items], [3.0, 0])
+        self.assertEqual(rsp.item.score, 5.0)
+
+
+class JceCodecTest(unittest.TestCase):
+
+    def test_generated_codec(self):
+        table = _JceFieldTable.get(DemoJce.get_struct_class())
+        self.assertTrue(table.encoder is not None and table.decoder is not None)
+        demo = DemoJce()
+        demo.id = 1 << 40
+        demo.name = "foo"
+        demo.array = [1, -2, 3]
+        demo.mapping = {"a": 1}
+        buff = demo.dumps(JceSerializer())
+        self.assertEqual(buff, demo.dumps(JceSerializer(use_codec=False)))
+        for serializer in [JceSerializer(), JceSerializer(lazy=True)]:
+            other = DemoJce()
+            other.loads(buff, serializer)
+            self.assertEqual(other.reduce(), demo.reduce())
+
+    def test_generate(self):
+        namespace = {}
+        exec(JceCodecGenerator().generate([JceItem, JceResponse]), namespace)
+        struct_class = JceResponse.get_struct_class()
+        table = _JceFieldTable.get(struct_class)
+        self.assertEqual(namespace["FIELDS_JceResponse"][-1], ("item", 22, False, "JceItem"))
+
+        rsp = JceSerializerTest("test_dumps_and_loads")._make_response()
+        value = rsp.reduce()
+        serializer = JceSerializer()
+        serializer._buf = BufferWriter()
+        namespace["encode_JceResponse"](serializer, value, table.types)
+        buff = serializer._buf.detach()
+        self.assertEqual(buff, rsp.dumps(JceSerializer()))
+
+        serializer._buf = BufferReader(buff)
+        data = namespace["decode_JceResponse"](serializer, struct_class, table.types, False)
+        self.assertEqual(data, JceSerializer().loads(struct_class, buff)[0])
+
+    def test_codec_module_lookup(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        sys.path.insert(0, tmpdir)
+        self.addCleanup(sys.path.remove, tmpdir)
+        with open(os.path.join(tmpdir, "jce_probe_unrelated_codec.py"), "w") as fd:
+            fd.write("FIELDS_ProbeItem = None\n")
+        with open(os.path.join(tmpdir, "jce_probe_broken_codec.py"), "w") as fd:
+            fd.write("__jce_codec__ = True\nimport jce_probe_missing_module\n")
+
+        class ProbeItem(Message):
+            _struct_ = [
+                Field("flag", Bool, tag=0),
+            ]
+
+        struct_class = ProbeItem.get_struct_class()
+        struct_class.__module__ = "jce_probe_missing"
+        self.assertEqual(_find_generated_codec(struct_class), (None, None))
+        struct_class.__module__ = "jce_probe_unrelated"
+        self.assertEqual(_find_generated_codec(struct_class), (None, None))
+        struct_class.__module__ = "jce_probe_broken"
+        self.assertRaises(ImportError, _find_generated_codec, struct_class)
+
+
+if __name__ == "__main__":
+    unittest.main()
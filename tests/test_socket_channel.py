@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-
 """test cases for ioloop
 """
+import errno
 import socket
 import threading
+import time
 import unittest
+import weakref
 
+from qt4s.addressing.direct import DirectAddressing
+from qt4s.channel.future import gather, wait_any
 from qt4s.channel.sock import SocketChannel, SocketGetResponseTimeoutError, \
-    SocketConnectionTimeoutError, RequestBase, ResponseBase
-from qt4s.message.definition import Field, Buffer
-from qt4s.message.serializers.binary import BinarySerializer
+    SocketConnectionTimeoutError, RequestBase, ResponseBase, PacketBase, PacketDecoder
+from qt4s.connections.sock import SocketConn, SocketCallback, SocketBufferOverflowError, ReceiveBuffer, \
+    DEFAULT_BUFF_SIZE
+from qt4s.message.definition import Field, Buffer, String, Uint16, Uint32
+from qt4s.message.serializers.binary import BinarySerializer, BinaryEndian
 from tests.simple_servers import TcpEchoServer, UdpEchoServer
 
 
@@ -37,6 +44,33 @@ class FooChannel(SocketChannel):
     request_class = FooRequest
 
 
+class SeqResponse(ResponseBase):
+    _struct_ = [
+        Field("length", Uint32),
+        Field("seq", Uint32),
+        Field("buffer", Buffer)
+    ]
+    _serializer_ = BinarySerializer()
+    _length_field_ = "length"
+
+    def get_sequence_id(self):
+        return self.seq
+
+
+class SeqRequest(RequestBase):
+    _struct_ = SeqResponse._struct_
+    _serializer_ = BinarySerializer()
+    _length_field_ = "length"
+    response_class = SeqResponse
+
+    def get_sequence_id(self):
+        return self.seq
+
+
+class SeqChannel(SocketChannel):
+    request_class = SeqRequest
+
+
 class SocketChannelTest(unittest.TestCase):
 
     @classmethod
@@ -82,6 +116,32 @@ class SocketChannelTest(unittest.TestCase):
         self.assertEqual(data, rsp.buffer)
         self.assertEqual(rsp.request, req)
 
+    def test_tcp_send_async(self):
+        chan = SeqChannel(host=self.tcp_host, port=self.tcp_port)
+        self.addCleanup(chan.close)
+        reqs = [SeqRequest(length=0, seq=i, buffer="x" * i, timeout=5) for i in range(200)]
+        futures = [chan.send_async(req) for req in reqs]
+        self.assertTrue(wait_any(futures, 5) in futures)
+        rsps = gather(futures, 5)
+        for i, rsp in enumerate(rsps):
+            self.assertEqual(rsp.seq, i)
+            self.assertEqual(rsp.buffer, "x" * i)
+            self.assertTrue(rsp.request is reqs[i])
+        self.assertEqual(chan.send(SeqRequest(length=0, seq=1, buffer="x", timeout=5)).buffer, "x")
+        self.assertEqual(chan.get_response_async(reqs[0]).result(5).seq, 0)
+
+    def test_tcp_send_async_timeout(self):
+
+        class _PushRequest(FooRequest):
+
+            def get_sequence_id(self):
+                return 1
+
+        chan = FooChannel(host=self.tcp_host, port=self.tcp_port)
+        self.addCleanup(chan.close)
+        future = chan.send_async(_PushRequest("xxxx", timeout=0.5))
+        self.assertTrue(isinstance(future.exception(5), SocketGetResponseTimeoutError))
+
     def test_tcp_on_push(self):
 
         class _PushRequest(FooRequest):
@@ -133,5 +193,332 @@ class SocketChannelTest(unittest.TestCase):
         self.assertRaises(SocketGetResponseTimeoutError, chan.send, FooRequest("xxxx", timeout=1))
 
 
+class LengthPacket(PacketBase):
+    _struct_ = [
+        Field("magic", Uint16),
+        Field("header", [
+            Field("tag", String, byte_size=2),
+            Field("length", Uint32),
+        ]),
+        Field("buffer", Buffer),
+    ]
+    _serializer_ = BinarySerializer()
+    _length_field_ = "header.length"
+
+
+class AdjustedLengthPacket(LengthPacket):
+    _length_adjust_ = 8
+
+
+class VariableHeaderPacket(PacketBase):
+    _struct_ = [
+        Field("name", String),
+        Field("length", Uint32),
+    ]
+    _serializer_ = BinarySerializer()
+    _length_field_ = "length"
+
+
+class FramePlanTest(unittest.TestCase):
+
+    def _pack(self, packet_class, data):
+        packet = packet_class()
+        packet.magic = 1
+        packet.header.tag = "xx"
+        packet.buffer = data
+        packet.set_message_length(packet._serializer_)
+        return packet.dumps()
+
+    def test_length_field(self):
+        plan = LengthPacket.get_frame_plan(LengthPacket._serializer_)
+        self.assertEqual(plan.offset, 4)
+        self.assertTrue(LengthPacket.get_frame_plan(LengthPacket._serializer_) is plan)
+        buff = self._pack(LengthPacket, "abc")
+        packet = LengthPacket()
+        self.assertEqual(packet.get_message_length(buff[:6], None), None)
+        self.assertEqual(packet.get_message_length(buff[:-1], None), None)
+        self.assertEqual(packet.get_message_length(buff + "next", None), len(buff))
+        self.assertEqual(packet.get_message_length(memoryview(buff + "next"), None), len(buff))
+
+    def test_plan_cache(self):
+        serializer = BinarySerializer(BinaryEndian.Network)
+        plan = LengthPacket.get_frame_plan(serializer)
+        self.assertTrue(LengthPacket.get_frame_plan(BinarySerializer(BinaryEndian.Network)) is plan)
+        self.assertTrue(LengthPacket.get_frame_plan(BinarySerializer(BinaryEndian.LittleEndian)) is not plan)
+        self.assertTrue(AdjustedLengthPacket.get_frame_plan(serializer) is not plan)
+        ref = weakref.ref(serializer)
+        del serializer
+        self.assertEqual(ref(), None)
+
+    def test_length_adjust(self):
+        buff = self._pack(AdjustedLengthPacket, "abc")
+        packet = AdjustedLengthPacket()
+        self.assertEqual(packet.get_message_length(buff + "next", None), len(buff))
+        packet.loads(buff)
+        self.assertEqual(packet.header.length, len(buff) - 8)
+
+    def test_variable_offset(self):
+        self.assertEqual(VariableHeaderPacket.get_frame_plan(VariableHeaderPacket._serializer_), None)
+        packet = VariableHeaderPacket()
+        packet.name = "xx"
+        packet.length = 0
+        buff = packet.dumps()  # length is set when dumping
+        self.assertEqual(packet.get_message_length(buff + "xxxx", None), len(buff))
+        self.assertEqual(packet.get_message_length(buff[:-1], None), None)
+
+
+class StreamedLengthPacket(LengthPacket):
+    _stream_field_ = "buffer"
+
+
+class TaggedLengthPacket(LengthPacket):
+
+    def get_message_length(self, buff, serializer):
+        if buff.find("xx", 2, 4) < 0:  # str methods are available
+            return None
+        return super(TaggedLengthPacket, self).get_message_length(buff, serializer)
+
+
+class PacketDecoderTest(unittest.TestCase):
+
+    def _pack(self, packet_class, data):
+        return FramePlanTest._pack.__func__(self, packet_class, data)
+
+    def _feed(self, decoder, buff, step):
+        recv_buf = ReceiveBuffer(8)
+        packets, chunks = [], []
+        for i in range(0, len(buff), step):
+            recv_buf.write(buff[i:i + step])
+            decoder.decode(recv_buf, packets.append, lambda packet, chunk: chunks.append(chunk))
+        self.assertEqual(len(recv_buf), 0)
+        return packets, chunks
+
+    def test_partial_packets(self):
+        buff = self._pack(LengthPacket, "abc") + self._pack(LengthPacket, "defgh")
+        packets, chunks = self._feed(PacketDecoder(LengthPacket), buff, 3)
+        self.assertEqual([packet.buffer for packet in packets], ["abc", "defgh"])
+        self.assertEqual(chunks, [])
+
+    def test_stream_field(self):
+        buff = self._pack(StreamedLengthPacket, "abcdefg") + self._pack(StreamedLengthPacket, "")
+        packets, chunks = self._feed(PacketDecoder(StreamedLengthPacket), buff, 5)
+        self.assertEqual(len(packets), 2)
+        self.assertEqual(packets[0].header.tag, "xx")
+        self.assertEqual(packets[0].header.length, 15)
+        self.assertEqual("".join(chunks), "abcdefg")
+        self.assertTrue(len(chunks) > 1)
+
+    def test_custom_message_length(self):
+        buff = self._pack(LengthPacket, "abc") + self._pack(LengthPacket, "defgh")
+        packets, _ = self._feed(PacketDecoder(TaggedLengthPacket), buff, 3)
+        self.assertEqual([packet.buffer for packet in packets], ["abc", "defgh"])
+
+    def test_bounded_message_length(self):
+        buff = self._pack(LengthPacket, "abc") * 1000
+        sizes = []
+
+        class RecordingPacket(TaggedLengthPacket):
+
+            def get_message_length(self, buff, serializer):
+                sizes.append(len(buff))
+                return super(RecordingPacket, self).get_message_length(buff, serializer)
+
+        recv_buf = ReceiveBuffer()
+        recv_buf.write(buff)
+        packets = []
+        PacketDecoder(RecordingPacket).decode(recv_buf, packets.append)
+        self.assertEqual(len(packets), 1000)
+        self.assertEqual(len(recv_buf), 0)
+        self.assertTrue(max(sizes) <= PacketDecoder.probe_size)
+
+    def test_whole_buffer_packet(self):
+        recv_buf = ReceiveBuffer()
+        recv_buf.write("x" * 10000)
+        packets = []
+        PacketDecoder(FooResponse).decode(recv_buf, packets.append)
+        self.assertEqual([packet.buffer for packet in packets], ["x" * 10000])
+
+    def test_invalid_stream_field(self):
+        class InvalidPacket(VariableHeaderPacket):
+            _stream_field_ = "name"
+        self.assertRaises(ValueError, PacketDecoder, InvalidPacket)
+
+
+class SilentCallback(SocketCallback):
+
+    def on_recv(self):
+        pass
+
+    def on_connected(self):
+        pass
+
+
+class SocketConnWriteTest(unittest.TestCase):
+
+    def _create_server(self):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        host, port = server.getsockname()
+        conn = SocketConn(DirectAddressing({"host": host, "port": port}).get_address(), SilentCallback())
+        conn.write_high_water_mark = 64 * 1024
+        conn.write_block_timeout = 0.5
+        conn.connect()
+        self.addCleanup(conn.close)
+        peer, _ = server.accept()
+        self.addCleanup(peer.close)
+        return conn, peer
+
+    def test_buffered_send(self):
+        conn, peer = self._create_server()
+        chunk = "x" * 4096
+        count = 0
+        while conn.pending_size == 0 and count < 4096:  # fill socket buffer without blocking
+            conn.send(chunk)
+            count += 1
+        self.assertTrue(conn.pending_size > 0)
+        conn.send("end")
+        expected_size = count * len(chunk) + 3
+        received = []
+        received_size = 0
+        peer.settimeout(5)
+        while received_size < expected_size:
+            data = peer.recv(65536)
+            if not data:
+                break
+            received.append(data)
+            received_size += len(data)
+        data = "".join(received)
+        self.assertEqual(len(data), expected_size)
+        self.assertTrue(data.endswith("xend"))
+        time.sleep(0.1)
+        self.assertEqual(conn.pending_size, 0)
+
+    def test_send_after_peer_closed(self):
+
+        class ClosingCallback(SilentCallback):
+            evt = threading.Event()
+
+            def on_closed(self):
+                self.evt.set()
+
+        conn, peer = self._create_server()
+        conn._callback = ClosingCallback()
+        peer.close()
+        self.assertTrue(conn._callback.evt.wait(5))
+        with self.assertRaises(socket.error) as cm:
+            conn.send("xxxx")
+        self.assertEqual(cm.exception.errno, errno.EPIPE)
+
+    def test_close_while_blocked(self):
+        conn, _ = self._create_server()
+        conn.write_block_timeout = 5
+        chunk = "x" * 4096
+        while conn.pending_size == 0:  # fill socket buffer without blocking
+            conn.send(chunk)
+        conn.write_high_water_mark = 0
+        threading.Timer(0.2, conn.close).start()
+        with self.assertRaises(socket.error) as cm:
+            conn.send(chunk)  # blocked until closed
+        self.assertEqual(cm.exception.errno, errno.EPIPE)
+
+    def test_send_overflow(self):
+        conn, _ = self._create_server()
+        chunk = "x" * 65536
+        with self.assertRaises(SocketBufferOverflowError):
+            for _ in range(4096):
+                conn.send(chunk)
+
+
+class CountingCallback(SilentCallback):
+
+    def __init__(self, expected):
+        self.count = 0
+        self.expected = expected
+        self.evt = threading.Event()
+
+    def on_recv(self):
+        self.count += 1
+        if self.count == self.expected:
+            self.evt.set()
+
+
+class SocketConnDatagramTest(unittest.TestCase):
+
+    def test_batch_send_and_recv(self):
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        peer.settimeout(5)
+        self.addCleanup(peer.close)
+        host, port = peer.getsockname()
+        count = 100
+        callback = CountingCallback(count)
+        conn = SocketConn(DirectAddressing({"host": host, "port": port, "proto": "UDP"}).get_address(), callback)
+        conn.connect()
+        self.addCleanup(conn.close)
+        conn.send_batch(["%03d" % i for i in range(count)])
+        addr = None
+        for i in range(count):
+            data, addr = peer.recvfrom(1024)
+            self.assertEqual(data, "%03d" % i)
+        for i in range(count):
+            peer.sendto("r%03d" % i, addr)
+        self.assertTrue(callback.evt.wait(5))
+        for i in range(count):
+            data, from_addr = conn.read()
+            self.assertEqual(data, "r%03d" % i)
+            self.assertEqual(from_addr, (host, port))
+        self.assertRaises(ValueError, SocketConn(DirectAddressing({"host": host, "port": port}).get_address(),
+                                                 callback).send_batch, ["xxx"])
+
+
+class ReceiveBufferTest(unittest.TestCase):
+
+    def test_recv_and_consume(self):
+        r, w = socket.socketpair()
+        self.addCleanup(r.close)
+        self.addCleanup(w.close)
+        buf = ReceiveBuffer(16)
+        w.send("0123456789")
+        self.assertEqual(buf.recv_from(r, 8), 8)
+        self.assertEqual(buf.peek().tobytes(), "01234567")
+        self.assertEqual(buf.read(3), "012")
+        self.assertEqual(buf.recv_from(r, 8), 2)
+        self.assertEqual(buf.peek(4).tobytes(), "3456")
+        self.assertEqual(buf.read(), "3456789")
+        self.assertEqual(len(buf), 0)
+
+    def test_compact_and_grow(self):
+        buf = ReceiveBuffer(8)
+        buf.write("abcdef")
+        buf.consume(4)
+        buf.write("ghijkl")  # compacted in place
+        self.assertEqual(buf.capacity, 8)
+        self.assertEqual(buf.peek().tobytes(), "efghijkl")
+        view = buf.peek()
+        buf.write("mnop")  # grown, old view is untouched
+        self.assertEqual(buf.capacity, 16)
+        self.assertEqual(view.tobytes(), "efghijkl")
+        self.assertEqual(buf.read(), "efghijklmnop")
+        self.assertRaises(ValueError, buf.consume, 1)
+
+    def test_shrink(self):
+        buf = ReceiveBuffer(8)
+        buf.write("0123456789abcdef0123")
+        self.assertEqual(buf.read(10), "0123456789")
+        self.assertTrue(buf.capacity > 8)
+        self.assertEqual(buf.read(), "abcdef0123")
+        self.assertEqual(buf.capacity, 8)
+
+    def test_lazy_allocation(self):
+        conn = SocketConn(DirectAddressing({"host": "127.0.0.1", "port": 80, "proto": "UDP"}).get_address(),
+                          SocketCallback())
+        self.assertEqual(conn._recv_buf, None)
+        conn = SocketConn(DirectAddressing({"host": "127.0.0.1", "port": 80}).get_address(), SocketCallback())
+        self.assertEqual(conn._recv_buf, None)
+        self.assertEqual(conn.recv_buffer.capacity, DEFAULT_BUFF_SIZE)
+
+
 if __name__ == "__main__":
     unittest.main(defaultTest="SocketChannelTest.test_udp_response_timeout")